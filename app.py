@@ -1,10 +1,8 @@
 import asyncio
 import logging
-import tempfile
 import polars as pl
 from typing import List
 from aiogram import Bot, Dispatcher
-from tqdm import tqdm
 from aiogram.types import Message
 from aiogram.filters import Command
 import os
@@ -12,129 +10,234 @@ from datetime import datetime
 from dotenv import load_dotenv
 from aiogram_media_group import media_group_handler
 from aiogram import F, types
-from aiogram.types import FSInputFile
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.types import BufferedInputFile
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 # from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 # import pandas as pd
 
-# from check import check_df
-from inn_check import check_by_inn
-from format import format_excel
-from merge import merge_tables_to_excel
-from async_app import process_image, get_head, process_image_mistral
+from check import validate_ledger
+from inn_check import MESSAGE_LIMIT, REGISTRY, Report, check_by_inn, close_dadata_async
+from inn_cache import cache_summary
+from merge import build_workbook_bytes
+from cpu import run_cpu, shutdown_cpu_pool
+from jobs import Job, JobQueue, WorkerPool
+from logs import setup_logging
+from metrics import album_metrics, span, start_metrics_server, stats_text, stop_metrics_server
+from pipeline import process_album
+import providers
+from progress import ProgressMessage, pack_messages
+from router import HEDGING, OCR_ROUTER
+from stitch import stitch_summary
+from modes import HEADERS
 
 load_dotenv()
 
-os.environ["POLARS_FMT_MAX_COLS"] = str(100)
-os.environ["POLARS_FMT_MAX_ROWS"] = str(1000)
-
 BOT_TOKEN = os.getenv("TOKEN")
+# Свой сервер Bot API (локальный telegram-bot-api или стенд bench.py)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
 admins = [461923889, 1002688109]
 
 
 CURRENT_MODE = "SALES_HEADERS"
-HEADERS = {
-    "SALES_HEADERS": [
-        "№ п/п",
-        "ИНН",
-        "Наименование",
-        "Счета-фактуры",
-        "Стоимость продаж с НДС в руб. и коп. (стр. 160)",
-        "Стоимость продаж облагаемых налогом всего (без суммы НДС, стр. 170 + 175 + 180 + 190)",
-        "Сумма НДС всего (стр. 200 + 210)",
-        "Доля продаж (стр. 160 + 220)",
-    ],
-    "SHOP_HEADERS": [
-        "№ п/п",
-        "ИНН",
-        "Наименование",
-        "Счета-фактуры",
-        "Стоимость покупок с НДС (стр. 170)",
-        "Сумма НДС (стр. 180)",
-        "Удельный вес вычетов",
-    ],
-}
-
-# Настройка логирования
-logging.basicConfig(level=logging.INFO)
-
-# Создаем папку для сохранения файлов, если её нет
-if not os.path.exists("downloaded_images"):
-    os.makedirs("downloaded_images")
+
+logger = logging.getLogger(__name__)
+
+# Сохранять ли копии присланных фото в downloaded_images/<время>/
+ARCHIVE_IMAGES = os.getenv("ARCHIVE_IMAGES", "1") == "1"
+
+# Если отчёты проверки не влезают в столько сообщений, они отправляются файлом
+REPORT_MAX_MESSAGES = int(os.getenv("REPORT_MAX_MESSAGES", 3))
+
+# Ссылки на фоновые задачи, чтобы их не собрал сборщик мусора
+background_tasks = set()
+
+
+def archive_image(folder_path: str, i: int, data: bytes):
+    os.makedirs(folder_path, exist_ok=True)
+    with open(f"{folder_path}/{i}.jpg", "wb") as f:
+        f.write(data)
 
 # Инициализация бота и диспетчера
-bot = Bot(token=BOT_TOKEN)
+session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+bot = Bot(token=BOT_TOKEN, session=session)
 dp = Dispatcher()
 
 
 
 
 
-@dp.message(F.media_group_id, F.content_type.in_({"photo"}), F.from_user.id.in_(admins))
-@media_group_handler
-async def album_handler(messages: List[types.Message]):
-    headers = HEADERS[CURRENT_MODE]
-    await messages[0].answer(f"Текущий режим:\n{"Продажи" if CURRENT_MODE == 'SALES_HEADERS' else 'Покупки'}")
-    await messages[0].answer(f"Текущие заголовки:\n{', '.join(headers)}")
+def mode_name(mode: str) -> str:
+    return "Продажи" if mode == "SALES_HEADERS" else "Покупки"
+
+
+def format_eta(seconds: float | None) -> str:
+    if seconds is None:
+        return "время пока неизвестно"
+    return f"примерно {max(1, round(seconds / 60))} мин"
+
+
+async def send_reports(chat_id: int, reports: list[Report], name: str):
+    """Отчёты проверки: маленькие склеиваются в общие сообщения, а если сообщений
+    получается больше REPORT_MAX_MESSAGES - всё уходит одним текстовым файлом."""
+    messages = pack_messages([message for report in reports for message in report.messages()])
+    if len(messages) > REPORT_MAX_MESSAGES:
+        text = "\n".join(report.text() for report in reports)
+        await bot.send_document(
+            chat_id, BufferedInputFile(text.encode("utf-8"), filename=f"{name} - проверка.txt")
+        )
+        return
+    for message in messages:
+        await bot.send_message(chat_id, message, parse_mode="MarkdownV2")
+
+
+async def run_album(job: Job):
+    """Обработка одного альбома из очереди: результаты уходят в чат задания."""
+    headers = HEADERS[job.mode]
+    count = len(job.file_ids)
 
     # from xlsxwriter import Workbook
 
-    images_list = []
     current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
     folder_path = f"downloaded_images/{current_time}"
-    if not os.path.exists(folder_path):
-        os.makedirs(folder_path)
-
-    for i, msg in enumerate(messages):
-        photo = msg.photo[-1]
-        file_path = f"{folder_path}/{i}.jpg"
-        images_list.append(file_path)
-        await bot.download(photo.file_id, destination=file_path)
+
+    async def download(i: int) -> bytes:
+        # Фото скачиваются параллельно прямо в память и сразу уходят на OCR,
+        # архивная копия на диск пишется в фоне и никого не задерживает
+        with span("download"):
+            buffer = await bot.download(job.file_ids[i])
+        data = buffer.getvalue()
+        if ARCHIVE_IMAGES:
+            task = asyncio.create_task(asyncio.to_thread(archive_image, folder_path, i, data))
+            background_tasks.add(task)
+            task.add_done_callback(background_tasks.discard)
+        return data
+
+    cap = job.caption
+    text = f"Изображений {count}\nCaption = {cap}"
+    # Весь ход обработки - в одном редактируемом сообщении
+    progress = ProgressMessage(bot, job.chat_id)
+    await progress.start(
+        mode=f"Режим: {mode_name(job.mode)}",
+        headers=f"Заголовки: {', '.join(headers)}",
+        album=f"Изображений {count}, подпись: {cap}",
+        head="Шапка: распознаётся",
+        pages=f"Страницы: 0/{count}",
+    )
+    # Все этапы альбома попадают в одну строку album_summary в логе
+    with album_metrics(job=job.id, mode=job.mode, pages=count):
+        try:
+            pages_done = 0
+
+            async def head_done(_table: pl.DataFrame, _name: str):
+                progress.set("head", "Шапка: готова")
+
+            async def page_done(i: int, _df: pl.DataFrame):
+                nonlocal pages_done
+                pages_done += 1
+                progress.set("pages", f"Страницы: {pages_done}/{count}")
+
+            # Каждая фотография идёт на OCR сразу после скачивания, шапка - вместе
+            # с первой страницей, ИНН проверяются по мере готовности страниц
+            album = await process_album(
+                count, download, headers, on_page=page_done, on_head=head_done
+            )
+            head_table, head_name, df = album.head_table, album.head_name, album.table
+            logger.info("%s", album.images_summary)
+            if HEDGING:
+                logger.info("%s", OCR_ROUTER.summary())
+            logger.debug("album df:\n%s", df)
+            progress.set("stitch", stitch_summary(album.duplicates_dropped, album.missing_numbers))
+            progress.set("stage", "Проверка названий")
+            # Сравнение названий - CPU-работа, уходит в пул процессов
+            with span("check_by_inn"):
+                table_df, *reports = await run_cpu(check_by_inn, df, album.suggestions)
+            if album.inn_repairs:
+                reports.append(
+                    Report(
+                        "Исправленные ИНН",
+                        album.inn_repairs,
+                        columns=("Наименование", "Старый ИНН", "Исправленный ИНН"),
+                    )
+                )
+            await send_reports(job.chat_id, reports, cap)
+            # Арифметика, НДС, повторы счетов-фактур и выбросы - строки с замечаниями подсвечиваются в книге
+            with span("validate"):
+                validation = await run_cpu(validate_ledger, table_df, job.mode)
+            progress.set("validation", validation.summary())
+            if album.parse_problems:
+                # Первые 30 строк, чтобы не упереться в лимит длины сообщения
+                problems = "\n".join(album.parse_problems[:30])
+                await bot.send_message(
+                    job.chat_id,
+                    f"Не удалось разобрать ({len(album.parse_problems)}):\n{problems}"[:MESSAGE_LIMIT],
+                )
+            caches = f"{cache_summary(album.inn_stats)}\n{cache_summary(album.ocr_stats, 'Кэш OCR')}"
+            logger.info("%s", caches)
+            progress.set("stage", "Сборка книги")
+            # Книга собирается уже отформатированной в пуле процессов и отправляется прямо из памяти
+            with span("build_workbook"):
+                workbook = await run_cpu(
+                    build_workbook_bytes, head_table, table_df, head_name, len(headers), validation.notes
+                )
+            excel_table = BufferedInputFile(workbook, filename=f"{cap}.xlsx")
+
+            with span("upload"):
+                await bot.send_document(job.chat_id, excel_table)
+            await progress.finish(stage="Готово", caches=caches)
+        except Exception as e:
+            # Трейсбек пишет воркер очереди
+            await progress.finish(stage="Ошибка")
+            await bot.send_message(job.chat_id, f"Ошибка, {e}")
+            raise
+        finally:
+            logger.info("%s", text)
+
+
+# Создаются в main(): под spawn процессы пула cpu.py заново выполняют модуль,
+# запущенный как __main__, и не должны трогать очередь заданий
+JOB_QUEUE: JobQueue | None = None
+WORKERS: WorkerPool | None = None
+
+
+@dp.message(F.media_group_id, F.content_type.in_({"photo"}), F.from_user.id.in_(admins))
+@media_group_handler
+async def album_handler(messages: List[types.Message]):
+    # Хэндлер только ставит альбом в очередь, обработкой занимаются воркеры
     cap = "NoneType"
     for mess in messages:
         if mess.caption:
             cap = mess.caption.replace("\n", " ")
             break
-    text = f"Изображений {len(messages)}\nCaption = {cap}"
-    await messages[-1].answer(text)
-    try:
-        df_list = []
-
-        # headers = get_headers(images_list[0])
-        head_table, head_name = get_head(images_list[0])
-
-        await messages[-1].answer("Шапка извлечена")
-        for i, img in enumerate(tqdm(images_list)):
-            df_list.append(process_image_mistral(img, headers))
-            await messages[-1].answer(f"Страница {i + 1} готова")
-        df: pl.DataFrame = pl.concat(df_list)
-        print(df)
-        df=df.with_columns(pl.all().str.replace("null", "(пусто)"))
-        table_df, fixed_table, unfixed_table, not_found, wrong = check_by_inn(df)
-        await messages[-1].answer(fixed_table, parse_mode="MarkdownV2")
-        await messages[-1].answer(unfixed_table, parse_mode="MarkdownV2")
-        await messages[-1].answer(not_found, parse_mode="MarkdownV2")
-        await messages[-1].answer(wrong, parse_mode="MarkdownV2")
-        work_book = merge_tables_to_excel(head_table, table_df, head_name, width=len(headers))
-        temp_file = tempfile.NamedTemporaryFile(suffix=".xlsx", delete=False)
-        work_book.save(temp_file.name)
-
-        # Форматируем Excel файл
-        format_excel(temp_file.name, head_table.height + 3)
-
-        excel_table = FSInputFile(path=temp_file.name, filename=f"{cap}.xlsx")
-
-        await messages[-1].answer_document(excel_table)
-        temp_file.close()
-
-        # Удаляем временный файл
-        os.unlink(temp_file.name)
-    except Exception as e:
-        print(f"Error: {e}")
-        await messages[-1].answer(f"Ошибка, {e}")
-
-    print(text)
+    job_id = JOB_QUEUE.enqueue(
+        user_id=messages[0].from_user.id,
+        chat_id=messages[0].chat.id,
+        mode=CURRENT_MODE,
+        caption=cap,
+        file_ids=[msg.photo[-1].file_id for msg in messages],
+    )
+    await messages[-1].answer(
+        f"Альбом #{job_id} в очереди, позиция {JOB_QUEUE.position(job_id)}, "
+        f"{format_eta(JOB_QUEUE.eta(job_id))}"
+    )
+
+
+@dp.message(Command("queue"), F.from_user.id.in_(admins))
+async def queue_status(message: Message):
+    queued, running = JOB_QUEUE.depth()
+    lines = [f"В очереди: {queued}, в работе: {running}"]
+    for job_id in JOB_QUEUE.user_jobs(message.from_user.id):
+        position = JOB_QUEUE.position(job_id)
+        state = "в работе" if position == 0 else f"позиция {position}"
+        lines.append(f"#{job_id}: {state}, {format_eta(JOB_QUEUE.eta(job_id))}")
+    await message.answer("\n".join(lines))
+
+
+@dp.message(Command("stats"), F.from_user.id.in_(admins))
+async def stage_stats(message: Message):
+    await message.answer(stats_text())
 
 
 @dp.message(Command("start"), F.from_user.id.not_in(admins))
@@ -146,7 +249,7 @@ async def cmd_start(message: Message):
 async def admin_start(message: Message):
     await message.answer(
         "Привет, админ! Отправь мне группу изображений с подписью, и я сохраню их в максимальном разрешении.\n"
-        "Для настройки режима используй команду /settings."
+        "Для настройки режима используй команду /settings, очередь альбомов - /queue, время этапов - /stats."
     )
 
 @dp.message(Command("settings"), F.from_user.id.in_(admins))
@@ -174,9 +277,36 @@ async def toggle_mode(callback_query: types.CallbackQuery):
     )
     await callback_query.answer("Режим обновлён!")
 
+async def on_startup():
+    # Тяжёлые библиотеки и клиенты API подгружаются в фоне, пока бот уже принимает сообщения
+    # (и индекс реестра контрагентов - он нужен первой же строке с неверным ИНН)
+    for warm in (providers.prewarm, REGISTRY.load):
+        task = asyncio.create_task(asyncio.to_thread(warm))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+
+async def on_shutdown():
+    await WORKERS.stop()
+    await close_dadata_async()
+    await stop_metrics_server()
+    shutdown_cpu_pool()
+
+
 async def main():
+    global JOB_QUEUE, WORKERS
+    # Настройка логирования: LOG_LEVEL, выборка сырых ответов моделей - см. logs.py
+    setup_logging()
+    JOB_QUEUE = JobQueue()
+    WORKERS = WorkerPool(JOB_QUEUE, run_album)
+    dp.startup.register(on_startup)
+    dp.shutdown.register(on_shutdown)
+    WORKERS.start()
+    await start_metrics_server()
     await dp.start_polling(bot)
 
 
 if __name__ == "__main__":
+    # Лучше запускать через run_bot.py: иначе каждый процесс пула cpu.py
+    # при старте заново импортирует весь бот
     asyncio.run(main())
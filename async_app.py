@@ -1,28 +1,48 @@
-import base64
+import asyncio
+import logging
 import os
+import time
+from collections import Counter
 from dotenv import load_dotenv
 import polars as pl
-import io
-from PIL import Image
-import mdpd
-from openai import OpenAI
 import re
-import pandas as pd
-from mistralai import Mistral
+from typing import TYPE_CHECKING
+import providers
+from images import PreparedImage, prepare_image, read_image
+from ocr_cache import OcrCache, ocr_key
+from md_table import RowStream, parse_markdown_table, rows_to_frame
+from logs import dump_raw
+from metrics import record_usage, span
+
+if TYPE_CHECKING:
+    from mistralai import Mistral
+    from openai import AsyncOpenAI, OpenAI
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # ANTHROPIC_API_KEY = os.getenv("ANTHROPIC_API_KEY")
-MAX_PARALLEL_REQUESTS = 5
+MAX_PARALLEL_REQUESTS = int(os.getenv("MAX_PARALLEL_REQUESTS", 5))
 # MISTRAL_CLIENT = Anthropic(api_key=ANTHROPIC_API_KEY)
 
-CHATGPT_CLIENT = OpenAI(
-    api_key=os.environ.get("OPENAI_API_KEY"),  # This is the default and can be omitted
-)
-MISTRAL_CLIENT = Mistral(
-    api_key=os.getenv("MISTRAL_API_KEY"),
-)
+# Клиенты OpenAI и Mistral создаются при первом запросе (providers.get), а не при импорте
 MODEL = os.getenv("MISTRAL_NAME")
+GPT_MODEL = "gpt-4o"
+# Меняйте при любой правке промптов или разбора ответа - старые записи кэша OCR перестанут совпадать
+PROMPT_VERSION = "3"
+OCR_CACHE = OcrCache()
+
+# Потоковый режим: строки таблицы разбираются по мере генерации, ответ с
+# неверной формой (больше STREAM_MAX_BAD_ROWS плохих строк) обрывается и
+# запрашивается заново, но не больше STREAM_RETRIES раз
+STREAMING = os.getenv("LLM_STREAMING", "0") == "1"
+STREAM_MAX_BAD_ROWS = int(os.getenv("STREAM_MAX_BAD_ROWS", 2))
+STREAM_RETRIES = int(os.getenv("STREAM_RETRIES", 1))
+
+# Общий лимит одновременных запросов к LLM на весь процесс (все альбомы всех админов)
+LLM_SEMAPHORE = asyncio.Semaphore(MAX_PARALLEL_REQUESTS)
+
 def extract_between_tags(tag: str, string: str, strip: bool = False) -> list[str]:
     ext_list = re.findall(f"<{tag}>(.+?)</{tag}>", string, re.DOTALL)
     if strip:
@@ -40,23 +60,24 @@ def convert_to_str(obj):
         return str(obj)
 
 
-def encode_image(image_path):
-    """Encode the image to base64."""
+def encode_image(image: str | bytes | PreparedImage):
+    """Encode the image (file path or raw bytes) to base64."""
+    if isinstance(image, PreparedImage):
+        return image.base64
     try:
-        with Image.open(image_path) as img:
-            buffered = io.BytesIO()
-            img.save(buffered, format="JPEG")
-            return base64.b64encode(buffered.getvalue()).decode("utf-8")
+        return prepare_image(read_image(image)).base64
     except Exception as e:
-        print(f"Error encoding image: {e}")
+        logger.error("Error encoding image: %s", e)
         return None
+
+
+async def encode_image_async(image: str | bytes | PreparedImage):
+    if isinstance(image, PreparedImage):
+        return image.base64
+    return await asyncio.to_thread(encode_image, image)
     
-def get_head(img: str, client: OpenAI = CHATGPT_CLIENT) -> tuple[pl.DataFrame, str]:
-    print("getting head")
-    base64_image = encode_image(img)
-    if base64_image is None:
-        return None
-    messages = [
+def _head_messages(base64_image: str) -> list[dict]:
+    return [
         {
             "role": "user",
             "content": [
@@ -77,31 +98,80 @@ def get_head(img: str, client: OpenAI = CHATGPT_CLIENT) -> tuple[pl.DataFrame, s
         {"role": "user", "content": "продолжай"},
     ]
 
-    response = client.chat.completions.create(model="gpt-4o", messages=messages)
-    # for chunk in response:
-    #     print(chunk.choices[0].delta.content or "NoData ", end="")
-    # return None, ""
-    output = response.choices[0].message.content
-    print(output)
+
+def _parse_head(output: str) -> tuple[pl.DataFrame, str]:
+    dump_raw("head", output)
     names = extract_between_tags("name", output)
     table_html = extract_between_tags("div", output)[0]
     table_name = names[0] if names else ""
-    print(table_html)
+    logger.debug("head html: %s", table_html)
+
+    import pandas as pd
 
     pandas_df = pd.read_html(table_html)[0]
     df = pl.from_pandas(pandas_df)
-    print("df:")
-    print(df)
+    logger.debug("head df:\n%s", df)
     return df, table_name
 
-def process_image_mistral(img: str, headers: list[str], client: Mistral = MISTRAL_CLIENT):
+
+def get_head(
+    img: str | bytes | PreparedImage,
+    client: "OpenAI | None" = None,
+    stats: Counter | None = None,
+) -> tuple[pl.DataFrame, str]:
+    client = client or providers.get("openai")
+    logger.debug("getting head")
     base64_image = encode_image(img)
-    h = f"|{" | ".join(headers)} | \n|{" - |" * len(headers)}"
-    print(headers)
-    print(h)
     if base64_image is None:
         return None
-    messages = [
+    key = ocr_key("head", GPT_MODEL, PROMPT_VERSION, base64_image)
+    cached = OCR_CACHE.get(key, stats)
+    if cached is not None:
+        return cached[0], cached[1]
+    with span("get_head"):
+        response = client.chat.completions.create(
+            model=GPT_MODEL, messages=_head_messages(base64_image)
+        )
+    record_usage("gpt-4o", response.usage)
+    # for chunk in response:
+    #     print(chunk.choices[0].delta.content or "NoData ", end="")
+    # return None, ""
+    df, table_name = _parse_head(response.choices[0].message.content)
+    OCR_CACHE.put(key, df, table_name)
+    return df, table_name
+
+
+async def get_head_async(
+    img: str | bytes | PreparedImage,
+    client: "AsyncOpenAI | None" = None,
+    stats: Counter | None = None,
+) -> tuple[pl.DataFrame, str]:
+    client = client or providers.get("openai_async")
+    logger.debug("getting head")
+    base64_image = await encode_image_async(img)
+    if base64_image is None:
+        return None
+    key = ocr_key("head", GPT_MODEL, PROMPT_VERSION, base64_image)
+    cached = OCR_CACHE.get(key, stats)
+    if cached is not None:
+        return cached[0], cached[1]
+    async with LLM_SEMAPHORE:
+        with span("get_head"):
+            response = await client.chat.completions.create(
+                model=GPT_MODEL, messages=_head_messages(base64_image)
+            )
+    record_usage("gpt-4o", response.usage)
+    df, table_name = _parse_head(response.choices[0].message.content)
+    OCR_CACHE.put(key, df, table_name)
+    return df, table_name
+
+def _table_header(headers: list[str]) -> str:
+    return "|" + " | ".join(headers) + " | \n|" + " - |" * len(headers)
+
+
+def _mistral_messages(base64_image: str, headers: list[str]) -> list[dict]:
+    h = _table_header(headers)
+    return [
         {
             "role": "user",
             "content": [
@@ -125,52 +195,301 @@ def process_image_mistral(img: str, headers: list[str], client: Mistral = MISTRA
         },
         {"role": "user", "content": "Всё ок, продолжай!"},
     ]
-    res = MISTRAL_CLIENT.chat.complete(model=MODEL, messages=messages, max_tokens=4096)
-    output = res.choices[0].message.content
-    print("output: \n" + output)
-    pandas_df = mdpd.from_md(output, header=headers)
-    df = pl.from_pandas(pandas_df)
-    print("df:")
-    print(df)
+
+
+def _gpt_messages(base64_image: str, headers: list[str]) -> list[dict]:
+    h = _table_header(headers)
+    return [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "text",
+                    "text": f"Преврати эту фотографию таблицы в таблицу MarkDown, в ней ровно {len(headers)} столбцов. В ИИН либо 10 (десять) у ЮРИДИЧЕСКОГО лица, либо 12 (двенадцать) цифр у ФИЗИЧЕСКОГО лица, не больше и не меньше. Твоя задача - максимально точно передать данные каждой конкретной ячейки, кроме . В конкретной ячейке может стоять заглушка, с надписью '(пусто)', меняй её на 'null', но НИКОГДА не ставь ни (пусто), ни null там, где этих надписей на изображении нет.",
+                },
+                {
+                    "type": "image_url",
+                    "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"},
+                },
+            ],
+        },
+        {
+            "role": "assistant",
+            "content": [{ "type": "text", "text": "Конечно, вот таблица в MarkDown:\n ```markdown\n" + h + "\n|" }] ,
+        },
+        {"role": "user", "content" : 'Всё ок, продолжай!'}
+    ]
+
+
+def _parse_table(
+    output: str, headers: list[str], problems: list[str] | None = None
+) -> pl.DataFrame:
+    dump_raw("table", output)
+    df, table_problems = parse_markdown_table(output, headers)
+    for problem in table_problems:
+        logger.info("parse problem: %s", problem)
+    if problems is not None:
+        problems.extend(table_problems)
+    logger.debug("df:\n%s", df)
+    return df
+
+
+async def _stream_table(
+    open_stream,
+    delta_text,
+    headers: list[str],
+    stats: Counter | None = None,
+    problems: list[str] | None = None,
+    on_rows=None,
+    provider: str = "",
+    usage_of=None,
+    on_sent=None,
+) -> pl.DataFrame:
+    """Читает поток ответа модели и разбирает строки таблицы по мере их готовности.
+
+    open_stream() - корутина, открывающая поток провайдера, delta_text(event) -
+    текст очередного события. on_rows(df) вызывается для каждой пачки готовых
+    строк, ещё до конца генерации; при повторе после обрыва строки могут прийти
+    второй раз, поэтому on_rows должен быть идемпотентным (например, запросы ИНН).
+    usage_of(event) - расход токенов, если провайдер прислал его в событии.
+    on_sent() вызывается, когда запрос получил место в LLM_SEMAPHORE и уходит провайдеру.
+    """
+    for attempt in range(STREAM_RETRIES + 1):
+        can_retry = attempt < STREAM_RETRIES
+        parser = RowStream(headers)
+        start = time.perf_counter()
+        aborted = False
+        usage = None
+        raw = []
+        async with LLM_SEMAPHORE:
+            if on_sent is not None:
+                on_sent()
+            with span(f"ocr_{provider}"):
+                async with await open_stream() as stream:
+                    async for event in stream:
+                        usage = (usage_of(event) if usage_of else None) or usage
+                        text = delta_text(event)
+                        raw.append(text)
+                        new_rows = parser.feed(text)
+                        if can_retry and len(parser.problems) > STREAM_MAX_BAD_ROWS:
+                            aborted = True
+                            break
+                        if new_rows and on_rows is not None:
+                            await on_rows(rows_to_frame(new_rows, headers)[0])
+        record_usage(provider, usage)
+        dump_raw(f"table stream {provider}", "".join(raw))
+        if aborted:
+            logger.warning(
+                "stream aborted after %d rows: %s, retrying", len(parser.rows), parser.problems[-1]
+            )
+            continue
+        new_rows = parser.close()
+        if new_rows and on_rows is not None:
+            await on_rows(rows_to_frame(new_rows, headers)[0])
+        break
+
+    seconds = time.perf_counter() - start
+    df, table_problems = parser.frame()
+    logger.info(
+        "page streamed: %d rows in %.1fs (%.1f rows/s)",
+        df.height, seconds, df.height / max(seconds, 1e-6),
+    )
+    for problem in table_problems:
+        logger.info("parse problem: %s", problem)
+    if problems is not None:
+        problems.extend(table_problems)
+    if stats is not None:
+        stats["stream_rows"] += df.height
+        stats["stream_seconds"] += seconds
+    return df
+
+
+def _mistral_delta(event) -> str:
+    content = event.data.choices[0].delta.content if event.data.choices else None
+    return content if isinstance(content, str) else ""
+
+
+def _openai_delta(chunk) -> str:
+    return (chunk.choices[0].delta.content or "") if chunk.choices else ""
+
+
+def _mistral_usage(event):
+    return event.data.usage
+
+
+def _openai_usage(chunk):
+    return chunk.usage
+
+
+def _cached_table(key: str, stats: Counter | None, problems: list[str] | None) -> pl.DataFrame | None:
+    """Таблица из кэша; проблемы разбора страницы повторяются в problems."""
+    cached = OCR_CACHE.get(key, stats)
+    if cached is None:
+        return None
+    df, _, page_problems = cached
+    for problem in page_problems:
+        logger.info("parse problem (cached): %s", problem)
+    if problems is not None:
+        problems.extend(page_problems)
     return df
 
+
+def _store_table(key: str, df: pl.DataFrame, page_problems: list[str], problems: list[str] | None):
+    """Кэширует таблицу вместе с проблемами разбора и передаёт их в problems."""
+    if problems is not None:
+        problems.extend(page_problems)
+    OCR_CACHE.put(key, df, problems=page_problems)
+
+
+def process_image_mistral(
+    img: str | bytes | PreparedImage,
+    headers: list[str],
+    client: "Mistral | None" = None,
+    stats: Counter | None = None,
+    problems: list[str] | None = None,
+):
+    client = client or providers.get("mistral")
+    base64_image = encode_image(img)
+    if base64_image is None:
+        return None
+    key = ocr_key("mistral", MODEL, PROMPT_VERSION, base64_image, headers)
+    df = _cached_table(key, stats, problems)
+    if df is not None:
+        return df
+    page_problems = []
+    with span("ocr_mistral"):
+        res = client.chat.complete(
+            model=MODEL, messages=_mistral_messages(base64_image, headers), max_tokens=4096
+        )
+    record_usage("mistral", res.usage)
+    df = _parse_table(res.choices[0].message.content, headers, page_problems)
+    _store_table(key, df, page_problems, problems)
+    return df
+
+
 def process_image(
-    img: str, headers: list[str], client: OpenAI = CHATGPT_CLIENT
+    img: str | bytes | PreparedImage,
+    headers: list[str],
+    client: "OpenAI | None" = None,
+    stats: Counter | None = None,
+    problems: list[str] | None = None,
 ) -> pl.DataFrame:
+    client = client or providers.get("openai")
     base64_image = encode_image(img)
-    h = f"|{" | ".join(headers)} | \n|{" - |" * len(headers)}"
-    print(headers)
-    print(h)
     if base64_image is None:
         return None
-    response = client.chat.completions.create(
-        model="gpt-4o",
-        messages=[
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": f"Преврати эту фотографию таблицы в таблицу MarkDown, в ней ровно {len(headers)} столбцов. В ИИН либо 10 (десять) у ЮРИДИЧЕСКОГО лица, либо 12 (двенадцать) цифр у ФИЗИЧЕСКОГО лица, не больше и не меньше. Твоя задача - максимально точно передать данные каждой конкретной ячейки, кроме . В конкретной ячейке может стоять заглушка, с надписью '(пусто)', меняй её на 'null', но НИКОГДА не ставь ни (пусто), ни null там, где этих надписей на изображении нет.",
-                    },
-                    {
-                        "type": "image_url",
-                        "image_url": {"url": f"data:image/jpeg;base64,{base64_image}"},
-                    },
-                ],
-            },
-            {
-                "role": "assistant",
-                "content": [{ "type": "text", "text": "Конечно, вот таблица в MarkDown:\n ```markdown\n" + h + "\n|" }] ,
-            },
-            {"role": "user", "content" : 'Всё ок, продолжай!'}
-        ],
-    )
+    key = ocr_key("gpt", GPT_MODEL, PROMPT_VERSION, base64_image, headers)
+    df = _cached_table(key, stats, problems)
+    if df is not None:
+        return df
+    page_problems = []
+    with span("ocr_gpt-4o"):
+        response = client.chat.completions.create(
+            model=GPT_MODEL,
+            messages=_gpt_messages(base64_image, headers),
+        )
+    record_usage("gpt-4o", response.usage)
+    df = _parse_table(response.choices[0].message.content, headers, page_problems)
+    _store_table(key, df, page_problems, problems)
+    return df
 
-    output = response.choices[0].message.content
-    print("output: \n" + output)
-    pandas_df = mdpd.from_md(output, header=headers)
-    df = pl.from_pandas(pandas_df)
-    print("df:")
-    print(df)
+
+async def process_image_mistral_async(
+    img: str | bytes | PreparedImage,
+    headers: list[str],
+    client: "Mistral | None" = None,
+    stats: Counter | None = None,
+    problems: list[str] | None = None,
+    on_rows=None,
+    on_sent=None,
+) -> pl.DataFrame:
+    client = client or providers.get("mistral")
+    base64_image = await encode_image_async(img)
+    if base64_image is None:
+        return None
+    key = ocr_key("mistral", MODEL, PROMPT_VERSION, base64_image, headers)
+    df = _cached_table(key, stats, problems)
+    if df is not None:
+        return df
+    page_problems = []
+    messages = _mistral_messages(base64_image, headers)
+    if STREAMING:
+        df = await _stream_table(
+            lambda: client.chat.stream_async(model=MODEL, messages=messages, max_tokens=4096),
+            _mistral_delta,
+            headers,
+            stats,
+            page_problems,
+            on_rows,
+            provider="mistral",
+            usage_of=_mistral_usage,
+            on_sent=on_sent,
+        )
+    else:
+        async with LLM_SEMAPHORE:
+            if on_sent is not None:
+                on_sent()
+            with span("ocr_mistral"):
+                res = await client.chat.complete_async(
+                    model=MODEL, messages=messages, max_tokens=4096
+                )
+        record_usage("mistral", res.usage)
+        df = _parse_table(res.choices[0].message.content, headers, page_problems)
+        if on_rows is not None:
+            await on_rows(df)
+    _store_table(key, df, page_problems, problems)
     return df
+
+
+async def process_image_async(
+    img: str | bytes | PreparedImage,
+    headers: list[str],
+    client: "AsyncOpenAI | None" = None,
+    stats: Counter | None = None,
+    problems: list[str] | None = None,
+    on_rows=None,
+    on_sent=None,
+) -> pl.DataFrame:
+    client = client or providers.get("openai_async")
+    base64_image = await encode_image_async(img)
+    if base64_image is None:
+        return None
+    key = ocr_key("gpt", GPT_MODEL, PROMPT_VERSION, base64_image, headers)
+    df = _cached_table(key, stats, problems)
+    if df is not None:
+        return df
+    page_problems = []
+    messages = _gpt_messages(base64_image, headers)
+    if STREAMING:
+        df = await _stream_table(
+            lambda: client.chat.completions.create(
+                model=GPT_MODEL,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},
+            ),
+            _openai_delta,
+            headers,
+            stats,
+            page_problems,
+            on_rows,
+            provider="gpt-4o",
+            usage_of=_openai_usage,
+            on_sent=on_sent,
+        )
+    else:
+        async with LLM_SEMAPHORE:
+            if on_sent is not None:
+                on_sent()
+            with span("ocr_gpt-4o"):
+                response = await client.chat.completions.create(
+                    model=GPT_MODEL,
+                    messages=messages,
+                )
+        record_usage("gpt-4o", response.usage)
+        df = _parse_table(response.choices[0].message.content, headers, page_problems)
+        if on_rows is not None:
+            await on_rows(df)
+    _store_table(key, df, page_problems, problems)
+    return df
+
@@ -0,0 +1,160 @@
+"""Пакетная переобработка архивных альбомов из downloaded_images/ без Telegram.
+
+Каждая папка <время>/ с фото 0.jpg, 1.jpg, ... проходит тот же конвейер,
+что и в боте (распознавание, check_by_inn, отформатированная книга), результат -
+<папка>.xlsx в каталоге --out. Уже готовые книги пропускаются, поэтому прерванный
+запуск можно просто повторить.
+
+    python batch.py downloaded_images/ --mode SHOP_HEADERS --out results/ --processes 4
+
+Папки обрабатываются в пуле процессов. Бюджет одновременных запросов к LLM и Dadata
+(и запросов Dadata в секунду) общий и делится между процессами поровну, поэтому
+процессов не больше, чем одновременных запросов в меньшем из бюджетов.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from modes import HEADERS
+
+# Цикл событий процесса-обработчика: семафоры конвейера живут на нём между папками
+_loop: asyncio.AbstractEventLoop | None = None
+
+
+def page_files(folder: Path) -> list[Path]:
+    """Фото альбома по порядку страниц: 0.jpg, 1.jpg, ..., 10.jpg."""
+    return sorted(
+        folder.glob("*.jpg"),
+        key=lambda p: (not p.stem.isdigit(), int(p.stem) if p.stem.isdigit() else 0, p.stem),
+    )
+
+
+def album_folders(root: Path) -> list[Path]:
+    return sorted(folder for folder in root.iterdir() if folder.is_dir() and page_files(folder))
+
+
+def _init_worker(env: dict[str, str]):
+    global _loop
+    # Лимиты читаются модулями конвейера при импорте, поэтому задаются до него
+    os.environ.update(env)
+    from logs import setup_logging
+
+    setup_logging()
+    _loop = asyncio.new_event_loop()
+
+
+async def _process_folder(folder: Path, mode: str, out_path: Path) -> int:
+    from check import validate_ledger
+    from inn_check import check_by_inn
+    from merge import build_workbook_bytes
+    from pipeline import process_album
+
+    headers = HEADERS[mode]
+    files = page_files(folder)
+
+    async def download(i: int) -> bytes:
+        return await asyncio.to_thread(files[i].read_bytes)
+
+    album = await process_album(len(files), download, headers)
+    table_df, *_reports = check_by_inn(album.table, album.suggestions, album.inn_stats)
+    validation = validate_ledger(table_df, mode)
+    workbook = build_workbook_bytes(
+        album.head_table, table_df, album.head_name, len(headers), validation.notes
+    )
+    # Книга появляется под своим именем только целиком - по ней и определяется готовность
+    partial = out_path.with_suffix(".part")
+    partial.write_bytes(workbook)
+    partial.replace(out_path)
+    return len(files)
+
+
+def process_folder(folder: str, mode: str, out_path: str) -> tuple[int, float]:
+    """Выполняется в процессе пула: (число страниц, секунды)."""
+    start = time.perf_counter()
+    pages = _loop.run_until_complete(_process_folder(Path(folder), mode, Path(out_path)))
+    return pages, time.perf_counter() - start
+
+
+def worker_env(processes: int, llm_budget: int, dadata_budget: int, dadata_rps: float) -> dict[str, str]:
+    return {
+        "MAX_PARALLEL_REQUESTS": str(max(1, llm_budget // processes)),
+        "DADATA_CONCURRENCY": str(max(1, dadata_budget // processes)),
+        "DADATA_RPS": str(dadata_rps / processes),
+        # Папки уже в отдельных процессах - CPU-этапы в потоках, без вложенного пула
+        "CPU_WORKERS": "0",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Переобработка архивных альбомов")
+    parser.add_argument("root", nargs="?", default="downloaded_images", type=Path)
+    parser.add_argument("--mode", default="SALES_HEADERS", choices=list(HEADERS))
+    parser.add_argument("--out", default="batch_results", type=Path)
+    parser.add_argument("--processes", type=int, default=2)
+    parser.add_argument(
+        "--llm-budget", type=int, default=int(os.getenv("MAX_PARALLEL_REQUESTS", 5)),
+        help="одновременных запросов к LLM на все процессы",
+    )
+    parser.add_argument(
+        "--dadata-budget", type=int, default=int(os.getenv("DADATA_CONCURRENCY", 10)),
+        help="одновременных запросов к Dadata на все процессы",
+    )
+    parser.add_argument(
+        "--dadata-rps", type=float, default=float(os.getenv("DADATA_RPS", 20)),
+        help="запросов к Dadata в секунду на все процессы",
+    )
+    parser.add_argument("--force", action="store_true", help="пересчитать и уже готовые папки")
+    args = parser.parse_args()
+
+    args.out.mkdir(parents=True, exist_ok=True)
+    folders = album_folders(args.root)
+    todo = [f for f in folders if args.force or not (args.out / f"{f.name}.xlsx").exists()]
+    print(f"Папок {len(folders)}, к обработке {len(todo)}, режим {args.mode}")
+    if not todo:
+        return
+
+    # Каждому процессу нужен хотя бы один запрос из бюджета, иначе бюджет превышен
+    processes = max(1, min(args.processes, args.llm_budget, args.dadata_budget))
+    if processes < args.processes:
+        print(f"--processes {args.processes} больше бюджета запросов, процессов будет {processes}")
+    env = worker_env(processes, args.llm_budget, args.dadata_budget, args.dadata_rps)
+    start = time.perf_counter()
+    total_pages = 0
+    failed = 0
+    with ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(env,),
+    ) as pool:
+        futures = {
+            pool.submit(process_folder, str(folder), args.mode, str(args.out / f"{folder.name}.xlsx")): folder
+            for folder in todo
+        }
+        for done, future in enumerate(as_completed(futures), 1):
+            folder = futures[future]
+            try:
+                pages, seconds = future.result()
+            except Exception as e:
+                failed += 1
+                print(f"[{done}/{len(todo)}] {folder.name}: ошибка {e!r}")
+                continue
+            total_pages += pages
+            minutes = (time.perf_counter() - start) / 60
+            print(
+                f"[{done}/{len(todo)}] {folder.name}: {pages} стр. за {seconds:.0f}s, "
+                f"всего {total_pages / minutes:.1f} стр/мин"
+            )
+    minutes = (time.perf_counter() - start) / 60
+    print(
+        f"Готово: {len(todo) - failed} папок, {total_pages} стр. за {minutes:.1f} мин "
+        f"({total_pages / minutes:.1f} стр/мин), ошибок {failed}"
+    )
+
+
+if __name__ == "__main__":
+    main()
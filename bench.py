@@ -0,0 +1,486 @@
+"""Офлайн-бенчмарк полного конвейера альбома без платных API.
+
+Поднимает локальный стенд: OpenAI и Mistral chat completions (ответы из
+записанных markdown-файлов или синтетические, с задержками из логнормального
+распределения), Dadata suggest/party из реестра фикстур и Telegram Bot API
+(getFile, скачивание фото, sendMessage, sendDocument). Каждый сценарий
+запускается в отдельном процессе: app.run_album на свежих кэшах.
+
+    python bench.py                          # 1, 10, 50 страниц, SALES и SHOP
+    python bench.py --pages 1 10 --time-scale 0.1 --json bench.json
+    python bench.py --recordings recorded/   # *.md - записанные ответы моделей
+
+В отчёте: время альбома, время этапов (metrics.py), пиковый RSS
+и число запросов к каждому API. С --preprocess - ещё экономия на фото:
+размер запроса, время подготовки и распознавания.
+
+    python bench.py --pages 10 --photos --preprocess
+"""
+import argparse
+import asyncio
+import io
+import json
+import math
+import os
+import random
+import resource
+import socket
+import sys
+import tempfile
+import time
+import zlib
+from collections import Counter
+from pathlib import Path
+
+import numpy as np
+from aiohttp import web
+from PIL import Image, ImageDraw
+
+from inn_validate import WEIGHTS_10
+from modes import HEADERS
+
+TOKEN = "123456:bench"
+CHAT_ID = 1
+# Медиана задержки в секундах и sigma логнормального распределения
+DEFAULT_LATENCY = {
+    "mistral": (4.0, 0.4),
+    "gpt-4o": (6.0, 0.5),
+    "dadata": (0.08, 0.3),
+    "telegram": (0.05, 0.2),
+}
+# Секунды задержки модели на каждый МБ запроса: загрузка фото и его токены
+DEFAULT_LATENCY_PER_MB = 0.5
+# Подготовка фото, которую сравнивает --preprocess
+PREPROCESS_ENV = {"IMAGE_CROP": "1", "IMAGE_DESKEW": "1", "IMAGE_CONTRAST": "1", "IMAGE_GRAYSCALE": "1"}
+REGISTRY_SIZE = 400
+ROWS_PER_PAGE = 25
+
+
+def make_inn(rng: random.Random) -> str:
+    digits = [rng.randint(0, 9) for _ in range(9)]
+    control = sum(d * w for d, w in zip(digits, WEIGHTS_10)) % 11 % 10
+    return "".join(map(str, digits)) + str(control)
+
+
+def make_registry(seed: int = 0) -> dict[str, str]:
+    """ИНН -> название для ответов Dadata."""
+    rng = random.Random(seed)
+    words = ["Ромашка", "Вектор", "Альфа", "Стройсервис", "Техномир", "Север", "Гранит", "Импульс"]
+    forms = ["ООО", "АО", "ПАО"]
+    return {
+        make_inn(rng): f'{rng.choice(forms)} "{rng.choice(words)}-{i}"'
+        for i in range(REGISTRY_SIZE)
+    }
+
+
+def make_page(i: int, width: int = 1654, height: int = 2339, photo: bool = False) -> bytes:
+    """Синтетическое фото страницы: сетка таблицы и "текст" в ячейках.
+    photo - как снимок монитора: наклон, муар, рамка и фон вокруг экрана."""
+    rng = random.Random(i)
+    img = Image.new("RGB", (width, height), "white")
+    draw = ImageDraw.Draw(img)
+    for y in range(150, height - 100, 80):
+        draw.line((60, y, width - 60, y), fill=(90, 90, 90), width=2)
+        for x in range(80, width - 120, 200):
+            draw.rectangle((x, y + 25, x + rng.randint(40, 170), y + 50), fill=(30, 30, 30))
+    for x in range(60, width, 200):
+        draw.line((x, 150, x, height - 100), fill=(90, 90, 90), width=2)
+    if photo:
+        img = monitor_photo(img, rng)
+    buffered = io.BytesIO()
+    img.save(buffered, format="JPEG", quality=90)
+    return buffered.getvalue()
+
+
+def monitor_photo(screen: Image.Image, rng: random.Random) -> Image.Image:
+    width, height = screen.size
+    # Муар: полосы яркости от сетки пикселей монитора, чуть тусклее белого
+    y, x = np.mgrid[0:height, 0:width]
+    moire = 12 * np.sin((x * 0.9 + y * 0.35) / 3.1) + 12 * np.sin((y - x * 0.2) / 4.7)
+    pixels = np.asarray(screen, dtype=np.float32) * 0.9 + moire[..., None]
+    screen = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8))
+    # Рамка монитора и фон (стена, стол) с шумом матрицы камеры
+    bezel = Image.new("RGB", (width + 120, height + 120), (25, 25, 28))
+    bezel.paste(screen, (60, 60))
+    canvas_w, canvas_h = int(width * 1.5), int(height * 1.3)
+    noise = np.random.default_rng(rng.randrange(2**32)).normal(0, 6, (canvas_h, canvas_w, 1))
+    background = np.clip(np.array([150, 140, 125], dtype=np.float32) + noise, 0, 255)
+    canvas = Image.fromarray(background.astype(np.uint8))
+    tilted = bezel.rotate(rng.uniform(-3, 3), resample=Image.BICUBIC, expand=True, fillcolor=(150, 140, 125))
+    canvas.paste(
+        tilted,
+        (rng.randint(0, canvas_w - tilted.width), rng.randint(0, max(0, canvas_h - tilted.height))),
+    )
+    return canvas
+
+
+def money(rng: random.Random) -> str:
+    value = f"{rng.uniform(1_000, 5_000_000):,.2f}"
+    return value.replace(",", " ").replace(".", ",")
+
+
+def synthetic_table(seed: int, columns: int, registry: list[tuple[str, str]]) -> str:
+    """Ответ модели: строки markdown-таблицы с ИНН из реестра. Часть названий
+    искажена (нечёткое сравнение), часть ИНН с ошибкой OCR (ремонт ИНН)."""
+    rng = random.Random(seed)
+    lines = []
+    for n in range(1, ROWS_PER_PAGE + 1):
+        inn, name = rng.choice(registry)
+        if rng.random() < 0.3:
+            name = name.upper().replace('"', "")
+        if rng.random() < 0.05:
+            inn = inn[:-1] + str((int(inn[-1]) + 1) % 10)
+        cells = [str(n), inn, name, f"{rng.randint(1, 9999)} от 0{rng.randint(1, 9)}.03.2024"]
+        cells += [money(rng) for _ in range(columns - 5)]
+        cells.append(f"{rng.uniform(0, 5):.2f}".replace(".", ","))
+        lines.append("| " + " | ".join(cells) + " |")
+    return "\n".join(lines) + "\n```"
+
+
+def head_output(seed: int) -> str:
+    return (
+        f'Книга продаж {seed % 100}</name>\n<div><table>'
+        "<tr><td>Налогоплательщик</td><td>ООО \"Бенчмарк\"</td></tr>"
+        "<tr><td>ИНН/КПП</td><td>7707083893/770701001</td></tr>"
+        "<tr><td>Период</td><td>1 квартал 2024</td></tr>"
+        "</table></div>"
+    )
+
+
+class MockBackend:
+    """Стенд внешних API. calls - число запросов по каждому API."""
+
+    def __init__(
+        self,
+        latency: dict,
+        registry: dict[str, str],
+        recordings: list[str],
+        time_scale: float,
+        latency_per_mb: float = DEFAULT_LATENCY_PER_MB,
+    ):
+        self.latency = latency
+        self.latency_per_mb = latency_per_mb
+        self.registry = registry
+        self.registry_rows = sorted(registry.items())
+        self.recordings = recordings
+        self.time_scale = time_scale
+        self.rng = random.Random(42)
+        self.calls = Counter()
+        self.files: dict[str, bytes] = {}
+        self.message_id = 0
+
+    async def delay(self, api: str, size: int = 0):
+        median, sigma = self.latency[api]
+        seconds = median * math.exp(self.rng.gauss(0, sigma)) + size / 2**20 * self.latency_per_mb
+        await asyncio.sleep(seconds * self.time_scale)
+
+    def app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/openai/v1/chat/completions", self.chat("gpt-4o"))
+        app.router.add_post("/mistral/v1/chat/completions", self.chat("mistral"))
+        app.router.add_post("/dadata/suggest/party", self.suggest)
+        app.router.add_post("/telegram/bot{token}/{method}", self.telegram)
+        app.router.add_get("/telegram/file/bot{token}/{path:.*}", self.file)
+        return app
+
+    def answer(self, body: dict) -> tuple[str, str]:
+        """Вид запроса (шапка или таблица) и текст ответа. Ответ зависит только от фото."""
+        image, columns, head = "", 0, False
+        for message in body["messages"]:
+            content = message["content"]
+            parts = content if isinstance(content, list) else [{"type": "text", "text": content}]
+            for part in parts:
+                if part.get("type") == "image_url":
+                    url = part["image_url"]
+                    image = url if isinstance(url, str) else url["url"]
+                elif "<name>" in part.get("text", ""):
+                    head = True
+                elif " - |" in part.get("text", ""):
+                    columns = part["text"].count(" - |")
+        seed = zlib.crc32(image.encode())
+        if head:
+            return "head", head_output(seed)
+        if self.recordings:
+            return "table", self.recordings[seed % len(self.recordings)]
+        return "table", synthetic_table(seed, columns, self.registry_rows)
+
+    def chat(self, provider: str):
+        async def handler(request: web.Request) -> web.StreamResponse:
+            body = await request.json()
+            kind, text = self.answer(body)
+            self.calls[f"{provider} {kind}"] += 1
+            await self.delay(provider, request.content_length or 0)
+            usage = {
+                "prompt_tokens": 1200 + len(body["messages"]) * 20,
+                "completion_tokens": len(text) // 3,
+                "total_tokens": 1200 + len(text) // 3,
+            }
+            base = {"id": "bench", "created": int(time.time()), "model": body.get("model") or provider}
+            if not body.get("stream"):
+                return web.json_response({
+                    **base,
+                    "object": "chat.completion",
+                    "choices": [{
+                        "index": 0,
+                        "message": {"role": "assistant", "content": text},
+                        "finish_reason": "stop",
+                    }],
+                    "usage": usage,
+                })
+            response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+            await response.prepare(request)
+            lines = text.splitlines(keepends=True)
+            step = max(1, len(lines) // 10)
+            for i in range(0, len(lines), step):
+                chunk = {
+                    **base,
+                    "object": "chat.completion.chunk",
+                    "choices": [{"index": 0, "delta": {"content": "".join(lines[i:i + step])}, "finish_reason": None}],
+                }
+                await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode())
+                await asyncio.sleep(0.02 * self.time_scale)
+            final = {**base, "object": "chat.completion.chunk", "choices": [], "usage": usage}
+            if provider == "mistral":
+                final["choices"] = [{"index": 0, "delta": {"content": ""}, "finish_reason": "stop"}]
+            await response.write(f"data: {json.dumps(final)}\n\ndata: [DONE]\n\n".encode())
+            await response.write_eof()
+            return response
+
+        return handler
+
+    async def suggest(self, request: web.Request) -> web.Response:
+        inn = (await request.json())["query"]
+        self.calls["dadata suggest"] += 1
+        await self.delay("dadata")
+        name = self.registry.get(inn)
+        suggestions = [{"value": name, "data": {"inn": inn}}] if name else []
+        return web.json_response({"suggestions": suggestions})
+
+    async def telegram(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        form = await request.post()
+        self.calls[f"telegram {method}"] += 1
+        await self.delay("telegram")
+        if method == "getFile":
+            file_id = form["file_id"]
+            return web.json_response({"ok": True, "result": {
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "file_size": len(self.files[file_id]),
+                "file_path": f"photos/{file_id}.jpg",
+            }})
+        self.message_id += 1
+        message = {
+            "message_id": self.message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(form.get("chat_id", CHAT_ID)), "type": "private"},
+        }
+        if "text" in form:
+            message["text"] = form["text"]
+        return web.json_response({"ok": True, "result": message})
+
+    async def file(self, request: web.Request) -> web.Response:
+        file_id = Path(request.match_info["path"]).stem
+        self.calls["telegram download"] += 1
+        await self.delay("telegram")
+        return web.Response(body=self.files[file_id], content_type="image/jpeg")
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def scenario_env(base: str, workdir: str, preprocess: bool | None = None) -> dict[str, str]:
+    """Окружение процесса сценария: все API - на стенде, кэши и очередь - новые.
+    preprocess - включить или выключить подготовку фото (None - как в окружении)."""
+    overrides = {}
+    if preprocess is not None:
+        overrides = {name: value if preprocess else "0" for name, value in PREPROCESS_ENV.items()}
+    return {
+        **os.environ,
+        **overrides,
+        "TOKEN": TOKEN,
+        "TELEGRAM_API_URL": f"{base}/telegram",
+        "OPENAI_BASE_URL": f"{base}/openai/v1",
+        "OPENAI_API_KEY": "bench",
+        "MISTRAL_SERVER_URL": f"{base}/mistral",
+        "MISTRAL_API_KEY": "bench",
+        "MISTRAL_NAME": "mistral-bench",
+        "DADATA_KEY": "bench",
+        "BENCH_DADATA_URL": f"{base}/dadata/",
+        "INN_CACHE_PATH": os.path.join(workdir, "inn_cache.sqlite3"),
+        "OCR_CACHE_PATH": os.path.join(workdir, "ocr_cache.sqlite3"),
+        "REGISTRY_PATH": os.path.join(workdir, "registry.sqlite3"),
+        "JOBS_PATH": os.path.join(workdir, "jobs.sqlite3"),
+        "ARCHIVE_IMAGES": "0",
+        "METRICS_PORT": "0",
+        "LOG_LEVEL": os.getenv("LOG_LEVEL", "WARNING"),
+    }
+
+
+async def run_scenario(pages: int, mode: str) -> dict:
+    """Выполняется в процессе сценария: один альбом через app.run_album."""
+    import dadata.asynchr
+    import dadata.sync
+
+    # Dadata не настраивает адрес API - направляем клиенты на стенд
+    dadata.asynchr.SuggestClient.BASE_URL = os.environ["BENCH_DADATA_URL"]
+    dadata.sync.SuggestClient.BASE_URL = os.environ["BENCH_DADATA_URL"]
+
+    import app
+    import metrics
+    from cpu import shutdown_cpu_pool
+    from jobs import Job
+    from logs import setup_logging
+
+    setup_logging()
+
+    job = Job(
+        id=1, user_id=CHAT_ID, chat_id=CHAT_ID, mode=mode, caption="bench",
+        file_ids=[f"page{i}" for i in range(pages)],
+    )
+    start = time.perf_counter()
+    try:
+        await app.run_album(job)
+    finally:
+        wall = time.perf_counter() - start
+        await app.close_dadata_async()
+        await app.bot.session.close()
+    # Пул процессов закрывается до замера, чтобы его пик попал в RUSAGE_CHILDREN
+    shutdown_cpu_pool()
+    return {
+        "wall_s": wall,
+        "stages": {
+            stage: {"sum_s": h.sum, "count": h.count}
+            for stage, h in sorted(metrics.STAGES.items())
+            if stage != "album"
+        },
+        "payload_bytes": metrics.COUNTERS[("image_payload_bytes", ())],
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "children_peak_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+async def run_all(args) -> list[dict]:
+    recordings = []
+    if args.recordings:
+        recordings = [p.read_text(encoding="utf-8") for p in sorted(Path(args.recordings).glob("*.md"))]
+    latency = dict(DEFAULT_LATENCY)
+    for item in args.latency:
+        api, values = item.split("=")
+        median, sigma = values.split(":")
+        latency[api] = (float(median), float(sigma))
+    backend = MockBackend(latency, make_registry(), recordings, args.time_scale, args.latency_per_mb)
+    for i in range(max(args.pages)):
+        backend.files[f"page{i}"] = make_page(i, photo=args.photos)
+    # С --preprocess каждый сценарий идёт дважды: без подготовки фото и с ней
+    variants = [False, True] if args.preprocess else [None]
+
+    port = free_port()
+    runner = web.AppRunner(backend.app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", port).start()
+    results = []
+    try:
+        for mode in args.modes:
+            for pages in args.pages:
+                pair = []
+                for preprocess in variants:
+                    backend.calls.clear()
+                    with tempfile.TemporaryDirectory() as workdir:
+                        process = await asyncio.create_subprocess_exec(
+                            sys.executable, __file__, "--scenario", str(pages), mode,
+                            env=scenario_env(f"http://127.0.0.1:{port}", workdir, preprocess),
+                            stdout=asyncio.subprocess.PIPE,
+                        )
+                        stdout, _ = await process.communicate()
+                    if process.returncode != 0:
+                        raise RuntimeError(f"сценарий {mode} x{pages} завершился с кодом {process.returncode}")
+                    result = json.loads(stdout.decode().strip().splitlines()[-1])
+                    result.update(
+                        mode=mode, pages=pages, preprocess=preprocess, calls=dict(sorted(backend.calls.items()))
+                    )
+                    results.append(result)
+                    pair.append(result)
+                    print(report(result), flush=True)
+                if len(pair) == 2:
+                    print(savings(*pair), flush=True)
+    finally:
+        await runner.cleanup()
+    return results
+
+
+def per_photo(result: dict) -> dict[str, float]:
+    """Средние на фото: полезная нагрузка запроса (KB), подготовка (мс) и распознавание (с)."""
+    stages = result["stages"]
+    encode = stages.get("encode", {"sum_s": 0.0, "count": 0})
+    ocr = [s for stage, s in stages.items() if stage.startswith("ocr_")]
+    ocr_count = sum(s["count"] for s in ocr)
+    return {
+        "payload_kb": result["payload_bytes"] / 1024 / max(1, encode["count"]),
+        "prepare_ms": encode["sum_s"] * 1000 / max(1, encode["count"]),
+        "ocr_s": sum(s["sum_s"] for s in ocr) / max(1, ocr_count),
+    }
+
+
+def savings(before: dict, after: dict) -> str:
+    b, a = per_photo(before), per_photo(after)
+    return (
+        f"  подготовка фото: нагрузка {b['payload_kb']:.0f} -> {a['payload_kb']:.0f} KB/фото "
+        f"({a['payload_kb'] / b['payload_kb'] - 1:+.0%}), "
+        f"подготовка {b['prepare_ms']:.0f} -> {a['prepare_ms']:.0f} мс/фото, "
+        f"распознавание {b['ocr_s']:.2f} -> {a['ocr_s']:.2f} с/стр, "
+        f"альбом {before['wall_s']:.2f} -> {after['wall_s']:.2f} с"
+    )
+
+
+def report(result: dict) -> str:
+    stages = ", ".join(
+        f"{stage} {s['sum_s']:.2f}s/{s['count']}" for stage, s in result["stages"].items()
+    )
+    calls = ", ".join(f"{api} {n}" for api, n in result["calls"].items())
+    variant = {None: "", False: " без подготовки фото", True: " с подготовкой фото"}[result["preprocess"]]
+    return (
+        f"{result['mode']} x{result['pages']}{variant}: {result['wall_s']:.2f}s, "
+        f"RSS {result['peak_rss_mb']:.0f} MB (+пул {result['children_peak_rss_mb']:.0f} MB)\n"
+        f"  этапы: {stages}\n"
+        f"  запросы: {calls}"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк обработки альбома")
+    parser.add_argument("--pages", type=int, nargs="+", default=[1, 10, 50])
+    parser.add_argument("--modes", nargs="+", default=list(HEADERS), choices=list(HEADERS))
+    parser.add_argument(
+        "--latency", nargs="*", default=[],
+        help="api=медиана:sigma, например mistral=2:0.3 (api: mistral, gpt-4o, dadata, telegram)",
+    )
+    parser.add_argument("--time-scale", type=float, default=1.0, help="множитель всех задержек стенда")
+    parser.add_argument(
+        "--latency-per-mb", type=float, default=DEFAULT_LATENCY_PER_MB,
+        help="добавочная задержка модели в секундах на МБ запроса",
+    )
+    parser.add_argument("--photos", action="store_true", help="страницы как снимки монитора: рамка, наклон, муар")
+    parser.add_argument(
+        "--preprocess", action="store_true",
+        help="каждый сценарий без подготовки фото и с ней (обрезка, выравнивание, контраст, серый)",
+    )
+    parser.add_argument("--recordings", help="каталог с записанными ответами моделей (*.md)")
+    parser.add_argument("--json", help="сохранить результаты в файл")
+    parser.add_argument("--scenario", nargs=2, metavar=("PAGES", "MODE"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.scenario:
+        result = asyncio.run(run_scenario(int(args.scenario[0]), args.scenario[1]))
+        print(json.dumps(result))
+        return
+    results = asyncio.run(run_all(args))
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, ensure_ascii=False, indent=2), encoding="utf-8")
+
+
+if __name__ == "__main__":
+    main()
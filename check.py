@@ -1,29 +1,142 @@
+import os
+from dataclasses import dataclass
+
 import polars as pl
 
-def check_df(df: pl.DataFrame) -> tuple[pl.DataFrame, pl.DataFrame, float, int]:
-    correct_df = df.with_columns(
-        (
-            df["Стоимость продаж с НДС в руб. и коп. (стр. 160)"]
-            - (
-                df["Сумма НДС"]
-                + df[
-                    "Стоимость продаж облагаемых налогом всего (без суммы НДС, стр. 170 + 175 + 180 + 190)"
-                ]
-            )
-        ).alias("Разница сумм"),
-    ).with_columns((pl.col("Разница сумм") <= 3).alias("корректная обработка"))
-    summary_parts: float = (
-        correct_df.with_columns(
-            correct_df["Доля продаж (стр. 160 + 210)"]
-            .str.replace(",", ".")
-            .str.head(-1)
-            .cast(pl.Float64, strict=False)
-        )["Доля продаж (стр. 160 + 210)"]
-        .sum()
-        .__round__(2)
+from md_table import EMPTY
+
+# Допустимое расхождение "с НДС = без НДС + НДС" в рублях
+ARITHMETIC_TOLERANCE = float(os.getenv("CHECK_ARITHMETIC_TOLERANCE", 1))
+# Наибольшая ставка НДС в процентах: НДС строки не может быть больше
+MAX_VAT_RATE = float(os.getenv("CHECK_MAX_VAT_RATE", 22))
+# Допустимое отклонение суммы долей от 100% в процентных пунктах
+SHARE_TOLERANCE = float(os.getenv("CHECK_SHARE_TOLERANCE", 1))
+# Порог модифицированного z-score (по логарифму суммы) для выбросов
+OUTLIER_Z = float(os.getenv("CHECK_OUTLIER_Z", 3.5))
+# На коротких таблицах выбросы не ищем - медиане не на что опереться
+OUTLIER_MIN_ROWS = int(os.getenv("CHECK_OUTLIER_MIN_ROWS", 20))
+
+NOTES = "Замечания"
+INVOICES = "Счета-фактуры"
+
+
+@dataclass(frozen=True)
+class Ledger:
+    """Денежные столбцы режима. base - сумма без НДС, в книге покупок её нет."""
+
+    total: str
+    vat: str
+    share: str
+    base: str | None = None
+
+
+LEDGERS = {
+    "SALES_HEADERS": Ledger(
+        total="Стоимость продаж с НДС в руб. и коп. (стр. 160)",
+        base="Стоимость продаж облагаемых налогом всего (без суммы НДС, стр. 170 + 175 + 180 + 190)",
+        vat="Сумма НДС всего (стр. 200 + 210)",
+        share="Доля продаж (стр. 160 + 220)",
+    ),
+    "SHOP_HEADERS": Ledger(
+        total="Стоимость покупок с НДС (стр. 170)",
+        vat="Сумма НДС (стр. 180)",
+        share="Удельный вес вычетов",
+    ),
+}
+
+
+@dataclass
+class ValidationResult:
+    # Таблица без изменений плюс столбец NOTES (null - замечаний нет)
+    table: pl.DataFrame
+    flagged: int
+    share_sum: float | None
+
+    @property
+    def notes(self) -> list[str | None]:
+        return self.table[NOTES].to_list()
+
+    def summary(self) -> str:
+        lines = [f"Строк с замечаниями: {self.flagged} из {self.table.height}"]
+        if self.share_sum is not None and abs(self.share_sum - 100) > SHARE_TOLERANCE:
+            lines.append(f"Сумма долей {self.share_sum:.2f}% вместо 100%")
+        return "\n".join(lines)
+
+
+def _money(column: str) -> pl.Expr:
+    return pl.col(column).cast(pl.Float64)
+
+
+def _duplicate_invoices(indexed: pl.LazyFrame) -> pl.LazyFrame:
+    """Номера строк, счёт-фактура которых встречается и в другой строке.
+    В ячейке может быть несколько счетов через ";"."""
+    return (
+        indexed.select(
+            "__row",
+            pl.col(INVOICES).str.split(";").alias("__invoice"),
+        )
+        .explode("__invoice")
+        .with_columns(
+            pl.col("__invoice").str.strip_chars().str.to_lowercase().str.replace_all(r"\s+", " ")
+        )
+        .filter(pl.col("__invoice").is_not_null() & ~pl.col("__invoice").is_in(["", EMPTY]))
+        .unique(["__row", "__invoice"])
+        .filter(pl.col("__invoice").is_duplicated())
+        .select("__row")
+        .unique()
+        .with_columns(pl.lit(True).alias("__duplicate"))
+    )
+
+
+def validation_plan(lf: pl.LazyFrame, ledger: Ledger) -> pl.LazyFrame:
+    """Ленивый план проверок строк: арифметика, предел НДС, повторы счетов-фактур
+    и выбросы сумм. Результат - исходные столбцы и столбец NOTES."""
+    total, vat = _money(ledger.total), _money(ledger.vat)
+    if ledger.base is not None:
+        base = _money(ledger.base)
+        arithmetic = (total - (base + vat)).abs() > ARITHMETIC_TOLERANCE
+    else:
+        # Без столбца "без НДС" проверяется только, что НДС не больше суммы
+        base = total - vat
+        arithmetic = vat > total + ARITHMETIC_TOLERANCE
+    vat_limit = (vat < 0) | (vat > base * MAX_VAT_RATE / 100 + ARITHMETIC_TOLERANCE)
+
+    # Модифицированный z-score по логарифму суммы: суммы в книгах различаются на порядки
+    log_total = pl.when(total > 0).then(total.log10())
+    deviation = (log_total - log_total.median()).abs()
+    mad = deviation.median()
+    z = pl.when(mad > 0).then(0.6745 * deviation / mad)
+    outlier = (pl.len() >= OUTLIER_MIN_ROWS) & (z > OUTLIER_Z)
+
+    indexed = lf.with_row_index("__row")
+    notes = pl.concat_str(
+        [
+            pl.when(arithmetic).then(pl.lit("сумма с НДС не сходится")),
+            pl.when(vat_limit).then(pl.lit(f"НДС вне 0-{MAX_VAT_RATE:g}%")),
+            pl.when(pl.col("__duplicate")).then(pl.lit("повтор счёта-фактуры")),
+            pl.when(outlier).then(pl.lit("нетипичная сумма")),
+        ],
+        separator="; ",
+        ignore_nulls=True,
+    )
+    return (
+        indexed.join(_duplicate_invoices(indexed), on="__row", how="left", maintain_order="left")
+        .with_columns(pl.when(notes != "").then(notes).alias(NOTES))
+        .drop("__row", "__duplicate")
     )
 
-    problems_df = correct_df.filter(correct_df["корректная обработка"].not_())
-    h = problems_df.height
-    print(f"Сумма процентов доли продаж = {summary_parts}")
-    return (correct_df, problems_df, summary_parts, h)
+
+def validate_ledger(df: pl.DataFrame, mode: str) -> ValidationResult:
+    """Проверяет таблицу альбома одним запуском: планы строк и суммы долей
+    выполняются вместе, общая часть считается один раз."""
+    ledger = LEDGERS[mode]
+    lf = df.lazy()
+    table, share = pl.collect_all(
+        [validation_plan(lf, ledger), lf.select(pl.col(ledger.share).sum())]
+    )
+    share_sum = share.item() if df.height else None
+    return ValidationResult(
+        table=table,
+        flagged=table[NOTES].is_not_null().sum(),
+        share_sum=share_sum,
+    )
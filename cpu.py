@@ -0,0 +1,40 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from logs import setup_logging
+
+# Процессы для CPU-этапов (openpyxl, PIL, сравнение названий), чтобы они
+# не блокировали event loop бота и не мешали друг другу через GIL.
+# 0 - без пула, в потоках (например, внутри процессов batch.py)
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", max(1, (os.cpu_count() or 2) - 1)))
+
+_pool: ProcessPoolExecutor | None = None
+
+
+def cpu_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        # spawn: форк процесса с запущенным event loop и потоками небезопасен.
+        # Логи в spawn-процессе не настроены - без setup_logging INFO этапов теряются
+        _pool = ProcessPoolExecutor(
+            max_workers=CPU_WORKERS,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=setup_logging,
+        )
+    return _pool
+
+
+async def run_cpu(fn, *args):
+    """Выполняет fn(*args) в пуле процессов. fn и аргументы должны сериализоваться pickle."""
+    if CPU_WORKERS == 0:
+        return await asyncio.to_thread(fn, *args)
+    return await asyncio.get_running_loop().run_in_executor(cpu_pool(), fn, *args)
+
+
+def shutdown_cpu_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
@@ -1,10 +1,16 @@
-from openpyxl import load_workbook
-from openpyxl.styles import Alignment
-from openpyxl.utils import get_column_letter
+# Фиксированная ширина первых столбцов: № п/п, ИНН, Наименование, Счета-фактуры
+FIXED_WIDTHS = {1: 5, 2: 15, 3: 15, 4: 30}
+# Высота одной строки текста в ячейке
+LINE_HEIGHT = 15
 
 
 def format_excel(file_path: str, row_number: int):
-    print("execute format_excel")
+    """Форматирует уже сохранённый файл. Бот этим не пользуется:
+    merge_tables_to_excel сразу пишет отформатированную книгу."""
+    from openpyxl import load_workbook
+    from openpyxl.styles import Alignment
+    from openpyxl.utils import get_column_letter
+
     # Загружаем существующий Excel файл
     wb = load_workbook(file_path)
     ws = wb.active
@@ -30,21 +36,7 @@ def format_excel(file_path: str, row_number: int):
 
     # Устанавливаем ширину столбцов
     for col, width in column_widths.items():
-        if col == 1:
-            ws.column_dimensions[
-                get_column_letter(col)
-            ].width = 5  # стандартная ширина * 3
-        elif col == 2 or col == 3:
-            ws.column_dimensions[
-                get_column_letter(col)
-            ].width = 15  # стандартная ширина * 3
-        elif col == 4:
-            ws.column_dimensions[
-                get_column_letter(col)
-            ].width = 30  # стандартная ширина * 3
-
-        else:
-            ws.column_dimensions[get_column_letter(col)].width = width / 2
+        ws.column_dimensions[get_column_letter(col)].width = FIXED_WIDTHS.get(col, width / 2)
 
     # Установка высоты строк начиная с row_number
     for row in range(row_number, max_row + 1):
@@ -59,7 +51,7 @@ def format_excel(file_path: str, row_number: int):
         # Устанавливаем высоту строки, если текста достаточно
         if max_line_count > 1:
             ws.row_dimensions[row].height = (
-                max_line_count * 15
+                max_line_count * LINE_HEIGHT
             )  # кастомная высота на строку
 
     # Сохраняем изменения
@@ -0,0 +1,288 @@
+import asyncio
+import base64
+import hashlib
+import io
+import logging
+import os
+import time
+from dataclasses import dataclass, replace
+from typing import TYPE_CHECKING
+
+from cpu import run_cpu
+from metrics import inc, observe
+
+# numpy и Pillow импортируются при первой подготовке фото - обычно в процессе пула cpu
+if TYPE_CHECKING:
+    import numpy as np
+    from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+JPEG_MAGIC = b"\xff\xd8\xff"
+# Длинная сторона уменьшенной копии, по которой ищутся наклон и область таблицы
+WORK_SIDE = 1000
+# Наибольший искомый наклон фото в градусах
+MAX_SKEW = float(os.getenv("IMAGE_MAX_SKEW", 5))
+
+
+@dataclass(frozen=True)
+class ImagePolicy:
+    """Как готовить фото к отправке в модель.
+
+    max_side - ограничение длинной стороны в пикселях (0 - без ограничения),
+    quality - качество JPEG при перекодировании, grayscale - перевод в оттенки серого.
+    crop - обрезать до области таблицы (без рамки монитора и фона), deskew -
+    выровнять наклон, contrast - подавить муар и растянуть контраст.
+    Если ни одно преобразование не нужно, исходный JPEG уходит без перекодирования.
+    """
+
+    max_side: int = 0
+    quality: int = 90
+    grayscale: bool = False
+    crop: bool = False
+    deskew: bool = False
+    contrast: bool = False
+
+    @classmethod
+    def from_env(cls) -> "ImagePolicy":
+        return cls(
+            max_side=int(os.getenv("IMAGE_MAX_SIDE", 0)),
+            quality=int(os.getenv("IMAGE_QUALITY", 90)),
+            grayscale=os.getenv("IMAGE_GRAYSCALE", "0") == "1",
+            crop=os.getenv("IMAGE_CROP", "0") == "1",
+            deskew=os.getenv("IMAGE_DESKEW", "0") == "1",
+            contrast=os.getenv("IMAGE_CONTRAST", "0") == "1",
+        )
+
+    @property
+    def transforms(self) -> bool:
+        return self.max_side > 0 or self.grayscale or self.crop or self.deskew or self.contrast
+
+
+IMAGE_POLICY = ImagePolicy.from_env()
+
+
+@dataclass
+class PreparedImage:
+    base64: str
+    # Размер исходного файла и base64-полезной нагрузки запроса, в байтах
+    source_size: int
+    payload_size: int
+    seconds: float
+    passthrough: bool
+    # Найденный наклон в градусах и доля площади фото, оставшаяся после обрезки
+    angle: float = 0.0
+    kept: float = 1.0
+
+
+def _work_copy(img: "Image.Image") -> "Image.Image":
+    small = img.convert("L")
+    small.thumbnail((WORK_SIDE, WORK_SIDE))
+    return small
+
+
+def _edges(small: "Image.Image") -> "np.ndarray":
+    """Карта контуров: линии сетки и буквы. Муар сглаживается размытием
+    до поиска контуров."""
+    import numpy as np
+    from PIL import ImageFilter
+
+    edges = np.asarray(small.filter(ImageFilter.BoxBlur(1)).filter(ImageFilter.FIND_EDGES), dtype=np.float32)
+    # FIND_EDGES даёт ложный контур по краю кадра
+    edges[[0, -1], :] = 0
+    edges[:, [0, -1]] = 0
+    return edges > max(edges.mean() + edges.std(), 16)
+
+
+def detect_skew(small: "Image.Image") -> float:
+    """Угол в градусах (против часовой стрелки), на который надо повернуть фото,
+    чтобы строки таблицы стали горизонтальными. При верном угле профиль строк
+    карты контуров самый резкий: сумма квадратов разностей соседних строк максимальна."""
+    import numpy as np
+    from PIL import Image
+
+    edges = Image.fromarray(_edges(small).astype(np.uint8) * 255)
+
+    def sharpness(angle: float) -> float:
+        rows = np.asarray(edges.rotate(angle), dtype=np.float32).sum(axis=1)
+        return float(np.square(np.diff(rows)).sum())
+
+    coarse = max(np.arange(-MAX_SKEW, MAX_SKEW + 0.01, 0.5), key=sharpness)
+    return round(float(max(np.arange(coarse - 0.4, coarse + 0.41, 0.1), key=sharpness)), 1)
+
+
+def _longest_run(mask: "np.ndarray") -> tuple[int, int] | None:
+    """Самый длинный отрезок подряд идущих True: (начало, конец)."""
+    import numpy as np
+
+    padded = np.concatenate([[False], mask, [False]]).astype(np.int8)
+    changes = np.flatnonzero(np.diff(padded))
+    if not len(changes):
+        return None
+    starts, ends = changes[::2], changes[1::2]
+    longest = np.argmax(ends - starts)
+    return int(starts[longest]), int(ends[longest])
+
+
+def _dense(density: "np.ndarray") -> "np.ndarray":
+    import numpy as np
+
+    # Сглаживание склеивает строки таблицы с промежутками между ними
+    window = max(3, len(density) // 40)
+    smooth = np.convolve(density, np.ones(window) / window, mode="same")
+    return smooth > 0.15 * smooth.max()
+
+
+def table_box(small: "Image.Image", min_area: float = 0.15) -> tuple[float, float, float, float] | None:
+    """Область таблицы в долях ширины и высоты (left, top, right, bottom): самая длинная
+    полоса строк с контурами, а в ней - столбцов. На рамке монитора, столе и стене
+    контуров почти нет. None - таблица не найдена или занимает почти всё фото."""
+    edges = _edges(small)
+    if not edges.any():
+        return None
+    top, bottom = _longest_run(_dense(edges.mean(axis=1)))
+    left, right = _longest_run(_dense(edges[top:bottom].mean(axis=0)))
+    height, width = edges.shape
+    margin = 0.03
+    box = (
+        max(0.0, left / width - margin),
+        max(0.0, top / height - margin),
+        min(1.0, right / width + margin),
+        min(1.0, bottom / height + margin),
+    )
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    return box if min_area <= area <= 0.9 else None
+
+
+def preprocess(img: "Image.Image", policy: ImagePolicy) -> tuple["Image.Image", float, float]:
+    """Выравнивание, обрезка до таблицы, уменьшение и контраст.
+    Возвращает фото, угол поворота и оставшуюся долю площади."""
+    from PIL import Image, ImageFilter, ImageOps
+
+    angle, kept = 0.0, 1.0
+    small = _work_copy(img) if policy.deskew or policy.crop else None
+    if policy.deskew:
+        angle = detect_skew(small)
+        if abs(angle) >= 0.2:
+            # Уменьшенная копия поворачивается вместе с фото - по ней потом ищется таблица
+            img = img.rotate(angle, resample=Image.BILINEAR, expand=True, fillcolor="white")
+            small = small.rotate(angle, resample=Image.BILINEAR, expand=True, fillcolor=255)
+        else:
+            angle = 0.0
+    if policy.crop:
+        box = table_box(small)
+        if box is not None:
+            width, height = img.size
+            img = img.crop(
+                (int(box[0] * width), int(box[1] * height), int(box[2] * width), int(box[3] * height))
+            )
+            kept = (box[2] - box[0]) * (box[3] - box[1])
+    if policy.max_side > 0:
+        img.thumbnail((policy.max_side, policy.max_side))
+    if policy.contrast:
+        img = ImageOps.autocontrast(img.filter(ImageFilter.BoxBlur(1)), cutoff=1)
+    return img, angle, kept
+
+
+def prepare_image(data: bytes, policy: ImagePolicy = IMAGE_POLICY) -> PreparedImage:
+    start = time.perf_counter()
+    passthrough = not policy.transforms and data.startswith(JPEG_MAGIC)
+    angle, kept = 0.0, 1.0
+    if passthrough:
+        jpeg = data
+    else:
+        from PIL import Image
+
+        with Image.open(io.BytesIO(data)) as img:
+            img, angle, kept = preprocess(img.convert("L" if policy.grayscale else "RGB"), policy)
+            buffered = io.BytesIO()
+            img.save(buffered, format="JPEG", quality=policy.quality)
+            jpeg = buffered.getvalue()
+    encoded = base64.b64encode(jpeg).decode("utf-8")
+    prepared = PreparedImage(
+        base64=encoded,
+        source_size=len(data),
+        payload_size=len(encoded),
+        seconds=time.perf_counter() - start,
+        passthrough=passthrough,
+        angle=angle,
+        kept=kept,
+    )
+    logger.info(
+        "image prepared in %.1f ms: %d KB -> %d KB payload%s, skew %.1f°, kept %.0f%%",
+        prepared.seconds * 1000,
+        prepared.source_size // 1024,
+        prepared.payload_size // 1024,
+        " (passthrough)" if passthrough else "",
+        angle,
+        kept * 100,
+    )
+    return prepared
+
+
+def read_image(image: str | bytes) -> bytes:
+    if isinstance(image, bytes):
+        return image
+    with open(image, "rb") as f:
+        return f.read()
+
+
+def split_bands(data: bytes, bands: int, overlap: float) -> list[bytes]:
+    """Режет фото на bands горизонтальных полос одинаковой высоты. Соседние полосы
+    перекрываются на overlap высоты фото, чтобы строка на границе целиком попала
+    хотя бы в одну полосу; дубли потом убирает stitch.stitch_bands."""
+    from PIL import Image
+
+    with Image.open(io.BytesIO(data)) as img:
+        img = img.convert("RGB")
+        width, height = img.size
+        band_height = height / bands
+        margin = int(height * overlap)
+        result = []
+        for i in range(bands):
+            top = max(0, int(i * band_height) - margin)
+            bottom = min(height, int((i + 1) * band_height) + margin)
+            buffered = io.BytesIO()
+            img.crop((0, top, width, bottom)).save(buffered, format="JPEG", quality=95)
+            result.append(buffered.getvalue())
+    return result
+
+
+class AlbumImages:
+    """Кэш подготовленных фото одного альбома: каждое фото кодируется один раз,
+    даже если его одновременно запрашивают шапка и распознавание страницы."""
+
+    def __init__(self, policy: ImagePolicy = IMAGE_POLICY):
+        self.policy = policy
+        self._tasks: dict[tuple[str, ImagePolicy], asyncio.Task] = {}
+
+    async def prepare(self, image: str | bytes, crop: bool = True) -> PreparedImage:
+        """crop=False - без обрезки до таблицы, например для шапки над таблицей."""
+        data = read_image(image)
+        policy = self.policy if crop else replace(self.policy, crop=False)
+        key = (hashlib.sha1(data).hexdigest(), policy)
+        if key not in self._tasks:
+            self._tasks[key] = asyncio.create_task(self._prepare(data, policy))
+        return await self._tasks[key]
+
+    async def _prepare(self, data: bytes, policy: ImagePolicy) -> PreparedImage:
+        prepared = await run_cpu(prepare_image, data, policy)
+        observe("encode", prepared.seconds)
+        inc("image_payload_bytes", prepared.payload_size)
+        return prepared
+
+    def summary(self) -> str:
+        prepared = [
+            t.result()
+            for t in self._tasks.values()
+            if t.done() and not t.cancelled() and t.exception() is None
+        ]
+        if not prepared:
+            return "Фото не подготовлены"
+        source = sum(p.source_size for p in prepared)
+        payload = sum(p.payload_size for p in prepared)
+        seconds = sum(p.seconds for p in prepared)
+        return (
+            f"Фото: {len(prepared)}, исходно {source // 1024} KB, "
+            f"в запросах {payload // 1024} KB, подготовка {seconds * 1000:.0f} ms"
+        )
@@ -0,0 +1,104 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+INN_CACHE_PATH = os.getenv("INN_CACHE_PATH", "inn_cache.sqlite3")
+INN_CACHE_TTL = float(os.getenv("INN_CACHE_TTL_DAYS", 30)) * 24 * 3600
+INN_CACHE_MAX_ENTRIES = int(os.getenv("INN_CACHE_MAX_ENTRIES", 50_000))
+
+
+class InnCache:
+    """Локальный кэш ответов Dadata по ИНН в SQLite.
+
+    Записи старше ttl секунд считаются промахом, при превышении max_entries
+    вытесняются давно не использованные (LRU по времени последнего обращения).
+    Пустой ответ (организация не найдена) тоже кэшируется.
+    """
+
+    def __init__(
+        self,
+        path: str = INN_CACHE_PATH,
+        ttl: float = INN_CACHE_TTL,
+        max_entries: int = INN_CACHE_MAX_ENTRIES,
+    ):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS suggestions ("
+            "inn TEXT PRIMARY KEY, payload TEXT NOT NULL, "
+            "created REAL NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS suggestions_last_used ON suggestions (last_used)"
+        )
+        self._conn.commit()
+
+    def get(self, inn: str, stats: Counter | None = None) -> list[dict] | None:
+        return self.get_many([inn], stats).get(inn)
+
+    def get_many(self, inns: list[str], stats: Counter | None = None) -> dict[str, list[dict]]:
+        """Ответы по ИНН, которые есть в кэше и не устарели, одним запросом
+        и одной фиксацией на все ИНН - без отдельного UPDATE и commit на каждый."""
+        inns = list(dict.fromkeys(inns))
+        now = time.time()
+        rows = []
+        with self._lock:
+            # Не больше 900 параметров на запрос - ограничение старых сборок SQLite
+            for start in range(0, len(inns), 900):
+                chunk = inns[start : start + 900]
+                marks = ", ".join("?" * len(chunk))
+                rows += self._conn.execute(
+                    f"SELECT inn, payload, created FROM suggestions WHERE inn IN ({marks})", chunk
+                ).fetchall()
+            expired = [(inn,) for inn, _, created in rows if now - created > self.ttl]
+            found = {inn: payload for inn, payload, created in rows if now - created <= self.ttl}
+            if expired:
+                self._conn.executemany("DELETE FROM suggestions WHERE inn = ?", expired)
+            if found:
+                self._conn.executemany(
+                    "UPDATE suggestions SET last_used = ? WHERE inn = ?", [(now, inn) for inn in found]
+                )
+            if expired or found:
+                self._conn.commit()
+        if stats is not None:
+            stats["hits"] += len(found)
+            stats["misses"] += len(inns) - len(found)
+        return {inn: json.loads(payload) for inn, payload in found.items()}
+
+    def put(self, inn: str, suggestions: list[dict]):
+        now = time.time()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO suggestions VALUES (?, ?, ?, ?)",
+                (inn, json.dumps(suggestions, ensure_ascii=False), now, now),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        (count,) = self._conn.execute("SELECT COUNT(*) FROM suggestions").fetchone()
+        if count > self.max_entries:
+            self._conn.execute(
+                "DELETE FROM suggestions WHERE inn IN ("
+                "SELECT inn FROM suggestions ORDER BY last_used LIMIT ?)",
+                (count - self.max_entries,),
+            )
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM suggestions").fetchone()[0]
+
+
+def cache_summary(stats: Counter, title: str = "Кэш ИНН") -> str:
+    total = stats["hits"] + stats["misses"]
+    if not total:
+        return f"{title}: запросов не было"
+    return (
+        f"{title}: попаданий {stats['hits']}, промахов {stats['misses']} "
+        f"({stats['hits'] / total:.0%} из кэша)"
+    )
@@ -1,35 +1,283 @@
+import asyncio
+import logging
 import os
-from dadata import Dadata
+from collections import Counter
+from dataclasses import dataclass
+import re
 import polars as pl
-import numpy as np
-from thefuzz import fuzz
-from tqdm import tqdm
 from dotenv import load_dotenv
 load_dotenv()
+import providers
+from inn_cache import InnCache
+from inn_validate import inn_valid_expr, repair_candidates, valid_inns
+from metrics import inc, span
+from names import match_names
+from ratelimit import TokenBucket
+from registry import Registry
 
-def send_table(old: list[str], new: list[str], inn: list[str], header: str = 'Замены в тексте') -> str:
-    # Формируем таблицу с использованием текста
-    table = f"*{header}:*\n"
-    table += "```markdown\n"  # Кодовый блок для выравнивания
-    table += "| ИНН | Старая версия | Найденная в базе версия |\n"
-    table += "| - |-|- |\n"
+logger = logging.getLogger(__name__)
 
-    for o, n, i in zip(old, new, inn):
-        table += f"| {i} | {o} | {n} |\n"
-    table += "```\n"
+# Спецсимволы MarkdownV2 вне блока кода
+_MARKDOWN_SPECIAL = re.compile(r"([_*\[\]()~`>#+\-=|{}.!\\])")
+# Лимит длины одного сообщения Telegram
+MESSAGE_LIMIT = 4096
+
+
+def _escape_markdown(text: str) -> str:
+    return _MARKDOWN_SPECIAL.sub(r"\\\1", text)
+
+
+def _escape_code(text) -> str:
+    return str(text).replace("\\", "\\\\").replace("`", "\\`")
+
+
+def _table_row(cells) -> str:
+    return "| " + " | ".join(_escape_code(cell) for cell in cells) + " |"
+
+
+def _table_message(header: str, columns: tuple[str, str, str], lines: list[str]) -> str:
+    # Кодовый блок для выравнивания
+    return "\n".join(
+        [f"*{_escape_markdown(header)}:*", "```markdown", _table_row(columns), "| - |-|- |", *lines, "```\n"]
+    )
+
+
+@dataclass
+class Report:
+    """Таблица для отправки в чат: строки (ИНН, старая версия, новая версия)."""
+
+    header: str
+    rows: list[tuple[str, str, str]]
+    columns: tuple[str, str, str] = ("ИНН", "Старая версия", "Найденная в базе версия")
+
+    def messages(self, limit: int = MESSAGE_LIMIT) -> list[str]:
+        """MarkdownV2-сообщения не длиннее limit; длинная таблица делится по строкам."""
+        lines = [_table_row(row)[: limit // 2].rstrip("\\") for row in self.rows]
+        # Запас под номер части в заголовке
+        overhead = len(_table_message(self.header, self.columns, [])) + 16
+        parts: list[list[str]] = [[]]
+        size = overhead
+        for line in lines:
+            if parts[-1] and size + len(line) + 1 > limit:
+                parts.append([])
+                size = overhead
+            parts[-1].append(line)
+            size += len(line) + 1
+        if len(parts) == 1:
+            return [_table_message(self.header, self.columns, parts[0])]
+        return [
+            _table_message(f"{self.header} ({i}/{len(parts)})", self.columns, part)
+            for i, part in enumerate(parts, 1)
+        ]
+
+    def text(self) -> str:
+        """Та же таблица простым текстом - для отправки файлом."""
+        return "\n".join(
+            [f"{self.header}:", " | ".join(self.columns), *(" | ".join(map(str, row)) for row in self.rows), ""]
+        )
 
-    return table
 
-DADATA_KEY = os.environ["DADATA_KEY"]
 SIMILARITY_THRESHOLD = 90
+INN_CACHE = InnCache()
+REGISTRY = Registry()
+
+# Ограничения для асинхронных запросов в Dadata: одновременные запросы,
+# запросов в секунду (под квоту тарифа) и таймаут одного запроса в секундах
+DADATA_CONCURRENCY = int(os.getenv("DADATA_CONCURRENCY", 10))
+DADATA_RPS = float(os.getenv("DADATA_RPS", 20))
+DADATA_TIMEOUT = float(os.getenv("DADATA_TIMEOUT", 5))
+
+_dadata_semaphore = asyncio.Semaphore(DADATA_CONCURRENCY)
+_dadata_bucket = TokenBucket(DADATA_RPS)
+# Запросы, которые уже летят: один ИНН с разных страниц запрашивается один раз
+_inflight: dict[str, asyncio.Task] = {}
 
 def normalize_list_length(lst, target_length):
     """Расширяет список до заданной длины пустыми значениями."""
     return lst + [""] * (target_length - len(lst))
 
 
-def check_by_inn(df: pl.DataFrame) -> tuple[pl.DataFrame, str, str, str, str]:
-    print("Начало функции check_by_inn")
+def get_suggested_names(inn: str, suggestions: list[dict]) -> list[str]:
+    if len(inn) == 12:
+        # У ИП в таблицах пишут только ФИО
+        return [re.sub(r"^ИП\s+", "", item["value"]) for item in suggestions]
+    # Получаем списки названий организаций и ИНН
+    return [item["value"] for item in suggestions]
+
+
+def _known_suggestions(
+    inns: list[str], stats: Counter | None = None
+) -> tuple[dict[str, list[dict]], list[str]]:
+    """Ответы по ИНН из кэша Dadata и ИНН, которые остаётся запросить в Dadata.
+    В сеть уходят только ИНН с верными контрольными цифрами. Реестр контрагентов
+    здесь не смотрим: его записи не устаревают, и ИНН после INN_CACHE_TTL_DAYS
+    перестал бы обновляться - реестр только для поиска по названию и на случай
+    ошибки Dadata."""
+    inns = valid_inns(inns)
+    suggestions = INN_CACHE.get_many(inns, stats)
+    return suggestions, [inn for inn in inns if inn not in suggestions]
+
+
+def fetch_suggestions(inns: list[str], stats: Counter | None = None) -> dict[str, list[dict]]:
+    """Запрашивает в Dadata организации по каждому ИНН с верной контрольной суммой (без повторов).
+    Сначала смотрит в локальный кэш, в stats считает попадания и промахи."""
+    suggestions, missing = _known_suggestions(inns, stats)
+    if not missing:
+        return suggestions
+    from dadata import Dadata
+
+    with Dadata(providers.require_env("DADATA_KEY")) as dadata:
+        logger.info("Dadata: %d запросов", len(missing))
+        for inn in missing:
+            inc("dadata_calls")
+            with span("dadata"):
+                suggestions[inn] = dadata.suggest("party", inn)
+            INN_CACHE.put(inn, suggestions[inn])
+            REGISTRY.add_suggestions(suggestions[inn])
+    return suggestions
+
+
+@providers.provider("dadata_async")
+def _dadata_async():
+    """Один долгоживущий клиент (и пул соединений) на весь процесс бота.
+    Ключ DADATA_KEY нужен только здесь - при первом запросе, а не при импорте."""
+    from dadata import DadataAsync
+
+    return DadataAsync(providers.require_env("DADATA_KEY"), timeout=DADATA_TIMEOUT)
+
+
+async def close_dadata_async():
+    client = providers.drop("dadata_async")
+    if client is not None:
+        await client.close()
+
+
+async def _suggest_async(inn: str) -> list[dict]:
+    async with _dadata_semaphore:
+        await _dadata_bucket.acquire()
+        try:
+            inc("dadata_calls")
+            with span("dadata"):
+                result = await asyncio.wait_for(
+                    providers.get("dadata_async").suggest("party", inn), DADATA_TIMEOUT
+                )
+        except Exception as e:
+            inc("dadata_errors")
+            # Медленный или упавший запрос не должен останавливать весь альбом:
+            # берём последнюю известную запись реестра, иначе ИНН попадёт
+            # в "Не удалось найти"; в кэш ничего не пишем
+            logger.warning("Dadata lookup for %s failed: %r", inn, e)
+            known = await asyncio.to_thread(REGISTRY.suggestions, inn)
+            if known:
+                inc("registry_hits")
+            return known
+    INN_CACHE.put(inn, result)
+    await asyncio.to_thread(REGISTRY.add_suggestions, result)
+    return result
+
+
+async def fetch_suggestions_async(
+    inns: list[str], stats: Counter | None = None
+) -> dict[str, list[dict]]:
+    """То же, что fetch_suggestions, но все уникальные ИНН запрашиваются
+    параллельно (DADATA_CONCURRENCY, DADATA_RPS, DADATA_TIMEOUT)."""
+    suggestions, missing = _known_suggestions(inns, stats)
+    for inn in missing:
+        if inn not in _inflight:
+            _inflight[inn] = asyncio.create_task(_suggest_async(inn))
+            _inflight[inn].add_done_callback(lambda _t, inn=inn: _inflight.pop(inn, None))
+    results = await asyncio.gather(*(_inflight[inn] for inn in missing))
+    suggestions.update(zip(missing, results))
+    return suggestions
+
+
+def choose_repairs(
+    rows: list[tuple[str, str]],
+    candidates: dict[str, list[str]],
+    suggestions: dict[str, list[dict]],
+) -> dict[tuple[str, str], str]:
+    """Для пар (неверный ИНН, название) выбирает вариант исправления, у которого
+    название в Dadata совпадает с распознанным не хуже SIMILARITY_THRESHOLD."""
+    # Каждая пара (строка, вариант ИНН) - отдельный запрос к матрице похожести
+    pairs = [(inn, org_name, c) for inn, org_name in rows for c in candidates.get(inn, [])]
+    matches = match_names(
+        [org_name for _, org_name, _ in pairs],
+        [get_suggested_names(c, suggestions.get(c) or []) for _, _, c in pairs],
+    )
+    best: dict[tuple[str, str], tuple[str, float]] = {}
+    for (inn, org_name, candidate), (_, similarity) in zip(pairs, matches):
+        if similarity > best.get((inn, org_name), ("", 0))[1]:
+            best[(inn, org_name)] = (candidate, similarity)
+    return {
+        key: candidate
+        for key, (candidate, similarity) in best.items()
+        if similarity >= SIMILARITY_THRESHOLD
+    }
+
+
+def apply_repairs(df: pl.DataFrame, repairs: dict[tuple[str, str], str]) -> pl.DataFrame:
+    if not repairs:
+        return df
+    inn_col, name_col = df.columns[1], df.columns[2]
+    mapping = pl.DataFrame(
+        [(inn, name, new) for (inn, name), new in repairs.items()],
+        schema=[inn_col, name_col, "__repaired"],
+        orient="row",
+    )
+    return (
+        df.join(mapping, on=[inn_col, name_col], how="left", maintain_order="left")
+        .with_columns(pl.coalesce("__repaired", inn_col).alias(inn_col))
+        .drop("__repaired")
+    )
+
+
+async def repair_inns_async(
+    df: pl.DataFrame, stats: Counter | None = None
+) -> tuple[pl.DataFrame, list[tuple[str, str, str]], dict[str, list[dict]]]:
+    """Исправляет ИНН с неверной контрольной суммой (типичные ошибки OCR).
+    Что не исправилось так (неверная длина, пустой ИНН), ищется по названию
+    в реестре контрагентов.
+
+    Возвращает таблицу с исправленными ИНН, список исправлений
+    (название, старый ИНН, новый ИНН) и ответы Dadata по выбранным ИНН.
+    """
+    inn_col, name_col = df.columns[1], df.columns[2]
+    invalid = df.filter(~inn_valid_expr(inn_col)).select(inn_col, name_col).unique(maintain_order=True)
+    if invalid.is_empty():
+        return df, [], {}
+    candidates = {inn: repair_candidates(inn) for inn in invalid[inn_col].to_list()}
+    all_candidates = [c for cs in candidates.values() for c in cs]
+    suggestions = {}
+    repairs = {}
+    if all_candidates:
+        suggestions = await fetch_suggestions_async(all_candidates, stats)
+        repairs = choose_repairs(invalid.rows(), candidates, suggestions)
+    rest = [row for row in invalid.rows() if row not in repairs]
+    # Первый поиск строит индекс реестра - не в цикле событий
+    resolved = await asyncio.to_thread(REGISTRY.resolve, [name for _, name in rest]) if rest else []
+    for row, inn in zip(rest, resolved):
+        if inn is not None:
+            inc("registry_resolved")
+            repairs[row] = inn
+            suggestions[inn] = REGISTRY.suggestions(inn)
+    repaired = [(name, inn, new) for (inn, name), new in repairs.items()]
+    return apply_repairs(df, repairs), repaired, {new: suggestions[new] for new in repairs.values()}
+
+
+def check_by_inn(
+    df: pl.DataFrame,
+    suggestions: dict[str, list[dict]] | None = None,
+    stats: Counter | None = None,
+) -> tuple[pl.DataFrame, Report, Report, Report, Report]:
+    """suggestions - уже полученные ответы Dadata по ИНН (например, собранные
+    конвейером по мере готовности страниц); недостающие ИНН запрашиваются здесь."""
+    logger.debug("check_by_inn: %d строк", df.height)
+    inns: list[str] = df[df.columns[1]].to_list()
+    valid = set(valid_inns(inns))
+    suggestions = dict(suggestions or {})
+    suggestions.update(
+        fetch_suggestions([inn for inn in inns if inn not in suggestions], stats)
+    )
     
     # Результаты
     replace_map = {}
@@ -45,38 +293,33 @@ def check_by_inn(df: pl.DataFrame) -> tuple[pl.DataFrame, str, str, str, str]:
     wrong_inn = []
     wrong_name = []
 
+    # Похожесть названий считается сразу для всей таблицы одной матрицей
+    rows = df.rows()
+    matches = match_names(
+        [row[2] for row in rows],
+        [
+            get_suggested_names(row[1], suggestions.get(row[1]) or []) if row[1] in valid else []
+            for row in rows
+        ],
+    )
+
     # Работа с каждой строкой DataFrame
-    for row in tqdm(df.rows(), desc="Обработка строк"):
+    for row, (best_name, best_name_similarity) in zip(rows, matches):
         inn: str = row[1]
         org_name: str = row[2]
 
-        # Проверяем, что ИНН имеет длину 10 символов
+        # Проверяем длину и контрольные цифры ИНН
         # if len(inn) == 12:
         #     org_name = f'ИП {org_name.lower()}'
-        if len(inn) == 10 or len(inn) == 12:
-            with Dadata(DADATA_KEY) as dadata:
-                suggestions = dadata.suggest("party", inn)
+        if inn in valid:
+            inn_suggestions = suggestions.get(inn)
 
             # Если не нашлось ни одной организации
-            if not suggestions:
+            if not inn_suggestions:
                 not_found_inn.append(inn)
                 not_found_name.append(org_name)
                 continue
-            if len(inn) == 12:
-                suggested_names: list[str] = [item["value"][3:] for item in suggestions]
-            else:
-            # Получаем списки названий организаций и ИНН
-                suggested_names: list[str] = [item["value"] for item in suggestions]
-
-            # Сравниваем названия и ИНН
-            name_similarity = [fuzz.ratio(suggested_name.lower(), org_name.lower()) for suggested_name in suggested_names]
-
-            # Выбираем лучшее совпадение
-            best_name_idx = np.argmax(name_similarity) if name_similarity else 0
-            best_name_similarity = name_similarity[best_name_idx] if name_similarity else 0
-
             # Анализируем результаты
-            best_name = suggested_names[best_name_idx]
             if best_name_similarity >= SIMILARITY_THRESHOLD:
                 replace_map[org_name] = best_name
                 found.append(org_name)
@@ -92,9 +335,9 @@ def check_by_inn(df: pl.DataFrame) -> tuple[pl.DataFrame, str, str, str, str]:
 
     # Применяем замены в DataFrame
     updated_df = df.with_columns(df[df.columns[2]].replace(replace_map))
-    fixed_table = send_table(found, replaced, found_inns)
-    unfixed_table = send_table(found_but_unchanged_names, best_sim, found_but_unchanged_inns, header='Неудачные замены в тексте')
-    not_found_table = send_table(not_found_name, ["не найдено"] * len(not_found_name), not_found_inn, header='Не удалось найти')
-    wrong_table = send_table(wrong_name, ["не найдено"] * len(wrong_name), wrong_inn, header='Неправильная длина ИНН')
+    fixed_table = Report('Замены в тексте', list(zip(found_inns, found, replaced)))
+    unfixed_table = Report('Неудачные замены в тексте', list(zip(found_but_unchanged_inns, found_but_unchanged_names, best_sim)))
+    not_found_table = Report('Не удалось найти', [(inn, name, "не найдено") for inn, name in zip(not_found_inn, not_found_name)])
+    wrong_table = Report('Неверный ИНН (длина или контрольная сумма)', [(inn, name, "не найдено") for inn, name in zip(wrong_inn, wrong_name)])
     return updated_df, fixed_table, unfixed_table, not_found_table, wrong_table
 
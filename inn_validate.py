@@ -0,0 +1,72 @@
+import polars as pl
+
+# Весовые коэффициенты контрольных цифр ИНН (приказ ФНС): 10-значный ИНН
+# юридического лица и две контрольные цифры 12-значного ИНН физического лица
+WEIGHTS_10 = [2, 4, 10, 3, 5, 9, 4, 6, 8]
+WEIGHTS_11 = [7, 2, 4, 10, 3, 5, 9, 4, 6, 8]
+WEIGHTS_12 = [3, 7, 2, 4, 10, 3, 5, 9, 4, 6, 8]
+
+# Цифры, которые OCR чаще всего путает между собой
+OCR_CONFUSIONS = {
+    "0": "689",
+    "1": "47",
+    "2": "7",
+    "3": "589",
+    "4": "19",
+    "5": "36",
+    "6": "058",
+    "7": "12",
+    "8": "0369",
+    "9": "0348",
+}
+# Буквы, которые OCR ставит вместо цифр
+OCR_LETTERS = str.maketrans("OoОоDQIlі|ЗзБбSsBВZz", "00000011113366558822")
+
+
+def _digit(s: pl.Expr, i: int) -> pl.Expr:
+    return s.str.slice(i, 1).cast(pl.Int64, strict=False)
+
+
+def _control(s: pl.Expr, weights: list[int]) -> pl.Expr:
+    return pl.sum_horizontal(_digit(s, i) * w for i, w in enumerate(weights)) % 11 % 10
+
+
+def inn_valid_expr(column: str | pl.Expr) -> pl.Expr:
+    """Проверка контрольных цифр ИНН для всего столбца одним выражением.
+
+    Значение проверяется как есть: пробелы по краям срезает разбор ячеек
+    (md_table.split_row), а ИНН с пробелом неверен - иначе он ушёл бы в Dadata
+    и в ключ кэша вместе с пробелом. Такой ИНН чинит repair_candidates."""
+    s = pl.col(column) if isinstance(column, str) else column
+    length = s.str.len_chars()
+    valid_10 = (length == 10) & (_control(s, WEIGHTS_10) == _digit(s, 9))
+    valid_12 = (
+        (length == 12)
+        & (_control(s, WEIGHTS_11) == _digit(s, 10))
+        & (_control(s, WEIGHTS_12) == _digit(s, 11))
+    )
+    return (s.str.contains(r"^\d+$") & (valid_10 | valid_12)).fill_null(False)
+
+
+def valid_inns(inns: list[str]) -> list[str]:
+    """Уникальные ИНН из списка, прошедшие проверку контрольных цифр (порядок сохраняется)."""
+    unique = pl.Series("inn", list(dict.fromkeys(inns)), dtype=pl.String)
+    return unique.filter(unique.to_frame().select(inn_valid_expr("inn")).to_series()).to_list()
+
+
+def repair_candidates(inn: str) -> list[str]:
+    """Варианты исправления ИНН с ошибкой распознавания, проходящие контрольную сумму:
+    замена букв на похожие цифры, замена одной цифры на похожую и перестановка соседних."""
+    inn = (inn or "").strip().translate(OCR_LETTERS).replace(" ", "")
+    if not inn.isdigit() or len(inn) not in (10, 12):
+        return []
+    if valid_inns([inn]):
+        return [inn]
+    candidates = []
+    for i, d in enumerate(inn):
+        for replacement in OCR_CONFUSIONS[d]:
+            candidates.append(inn[:i] + replacement + inn[i + 1 :])
+    for i in range(len(inn) - 1):
+        if inn[i] != inn[i + 1]:
+            candidates.append(inn[:i] + inn[i + 1] + inn[i] + inn[i + 2 :])
+    return valid_inns(candidates)
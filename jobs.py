@@ -0,0 +1,172 @@
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import time
+from dataclasses import dataclass
+
+JOBS_PATH = os.getenv("JOBS_PATH", "jobs.sqlite3")
+# Сколько альбомов обрабатывается одновременно
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", 2))
+
+logger = logging.getLogger(__name__)
+
+# Порядок выдачи заданий: сначала пользователи с меньшим числом альбомов в работе,
+# среди них - самое старое задание. По нему же считается место в очереди
+_CLAIM_ORDER = "(SELECT COUNT(*) FROM jobs r WHERE r.user_id = j.user_id AND r.status = 'running'), id"
+
+
+@dataclass
+class Job:
+    id: int
+    user_id: int
+    chat_id: int
+    mode: str
+    caption: str
+    file_ids: list[str]
+
+
+class JobQueue:
+    """Очередь альбомов в SQLite: задания переживают перезапуск бота.
+
+    Справедливость между пользователями: следующим берётся задание того,
+    у кого сейчас меньше всего альбомов в работе, среди них - самое старое.
+    """
+
+    def __init__(self, path: str = JOBS_PATH):
+        self._conn = sqlite3.connect(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, "
+            "chat_id INTEGER NOT NULL, mode TEXT NOT NULL, caption TEXT NOT NULL, "
+            "file_ids TEXT NOT NULL, status TEXT NOT NULL DEFAULT 'queued', "
+            "created REAL NOT NULL, started REAL, finished REAL, error TEXT)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+        self._conn.commit()
+        self.changed = asyncio.Event()
+
+    def requeue_interrupted(self) -> int:
+        """Снова ставит в очередь задания, прерванные перезапуском. Вызывается только
+        владельцем воркеров при старте: в другом процессе "running" - живые задания."""
+        cursor = self._conn.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running'")
+        self._conn.commit()
+        return cursor.rowcount
+
+    def enqueue(self, user_id: int, chat_id: int, mode: str, caption: str, file_ids: list[str]) -> int:
+        cursor = self._conn.execute(
+            "INSERT INTO jobs (user_id, chat_id, mode, caption, file_ids, created) "
+            "VALUES (?, ?, ?, ?, ?, ?)",
+            (user_id, chat_id, mode, caption, json.dumps(file_ids), time.time()),
+        )
+        self._conn.commit()
+        self.changed.set()
+        return cursor.lastrowid
+
+    def claim(self) -> Job | None:
+        row = self._conn.execute(
+            "SELECT id, user_id, chat_id, mode, caption, file_ids FROM jobs j "
+            f"WHERE status = 'queued' ORDER BY {_CLAIM_ORDER} LIMIT 1"
+        ).fetchone()
+        if row is None:
+            return None
+        self._conn.execute(
+            "UPDATE jobs SET status = 'running', started = ? WHERE id = ?", (time.time(), row[0])
+        )
+        self._conn.commit()
+        return Job(*row[:5], file_ids=json.loads(row[5]))
+
+    def finish(self, job_id: int, error: str | None = None):
+        self._conn.execute(
+            "UPDATE jobs SET status = ?, finished = ?, error = ? WHERE id = ?",
+            ("failed" if error else "done", time.time(), error, job_id),
+        )
+        self._conn.commit()
+        self.changed.set()
+
+    def depth(self) -> tuple[int, int]:
+        """(в очереди, в работе)"""
+        counts = dict(
+            self._conn.execute(
+                "SELECT status, COUNT(*) FROM jobs WHERE status IN ('queued', 'running') GROUP BY status"
+            ).fetchall()
+        )
+        return counts.get("queued", 0), counts.get("running", 0)
+
+    def position(self, job_id: int) -> int | None:
+        """Место задания в очереди (1 - следующее), 0 - уже в работе, None - завершено.
+        Считается в порядке claim() при текущем числе альбомов в работе."""
+        row = self._conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if row is None or row[0] not in ("queued", "running"):
+            return None
+        if row[0] == "running":
+            return 0
+        queued = [
+            queued_id
+            for (queued_id,) in self._conn.execute(
+                f"SELECT id FROM jobs j WHERE status = 'queued' ORDER BY {_CLAIM_ORDER}"
+            ).fetchall()
+        ]
+        return queued.index(job_id) + 1
+
+    def user_jobs(self, user_id: int) -> list[int]:
+        return [
+            job_id
+            for (job_id,) in self._conn.execute(
+                "SELECT id FROM jobs WHERE user_id = ? AND status IN ('queued', 'running') ORDER BY id",
+                (user_id,),
+            ).fetchall()
+        ]
+
+    def average_duration(self, last: int = 20) -> float | None:
+        (avg,) = self._conn.execute(
+            "SELECT AVG(finished - started) FROM (SELECT finished, started FROM jobs "
+            "WHERE status = 'done' ORDER BY id DESC LIMIT ?)",
+            (last,),
+        ).fetchone()
+        return avg
+
+    def eta(self, job_id: int, workers: int = JOB_WORKERS) -> float | None:
+        """Примерное время до готовности задания в секундах по средней длительности альбома."""
+        position = self.position(job_id)
+        avg = self.average_duration()
+        if position is None or avg is None:
+            return None
+        return ((position - 1) // workers + 1) * avg if position else avg
+
+
+class WorkerPool:
+    """JOB_WORKERS корутин, которые забирают задания из очереди и отдают их handler(job)."""
+
+    def __init__(self, queue: JobQueue, handler, workers: int = JOB_WORKERS):
+        self.queue = queue
+        self.handler = handler
+        self.workers = workers
+        self._tasks: list[asyncio.Task] = []
+
+    async def _worker(self):
+        while True:
+            self.queue.changed.clear()
+            job = self.queue.claim()
+            if job is None:
+                await self.queue.changed.wait()
+                continue
+            try:
+                await self.handler(job)
+            except Exception as e:
+                logger.exception("job %d failed", job.id)
+                self.queue.finish(job.id, error=repr(e))
+            else:
+                self.queue.finish(job.id)
+
+    def start(self):
+        requeued = self.queue.requeue_interrupted()
+        if requeued:
+            logger.info("requeued %d interrupted jobs", requeued)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
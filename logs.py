@@ -0,0 +1,46 @@
+import logging
+import os
+import random
+from logging.handlers import RotatingFileHandler
+
+import polars as pl
+
+# Уровень логов бота: INFO в проде, DEBUG - с таблицами и промежуточными данными
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Сырые ответы моделей: в DEBUG пишутся все, иначе - доля LOG_SAMPLE_RATE (0 - ни одного)
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", 0))
+RAW_LOG_PATH = os.getenv("RAW_LOG_PATH", "raw_outputs.log")
+RAW_LOG_MAX_MB = float(os.getenv("RAW_LOG_MAX_MB", 20))
+RAW_LOG_BACKUPS = int(os.getenv("RAW_LOG_BACKUPS", 3))
+
+raw_logger = logging.getLogger("raw")
+# Сырые ответы идут только в свой файл, не в общий лог
+raw_logger.propagate = False
+
+
+def setup_logging():
+    logging.basicConfig(
+        level=LOG_LEVEL, format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+    )
+    if LOG_LEVEL == "DEBUG":
+        # Таблицы целиком печатаются только в отладке
+        pl.Config.set_tbl_cols(100)
+        pl.Config.set_tbl_rows(1000)
+    if LOG_LEVEL == "DEBUG" or LOG_SAMPLE_RATE > 0:
+        handler = RotatingFileHandler(
+            RAW_LOG_PATH,
+            maxBytes=int(RAW_LOG_MAX_MB * 1024 * 1024),
+            backupCount=RAW_LOG_BACKUPS,
+            encoding="utf-8",
+        )
+        handler.setFormatter(logging.Formatter("%(asctime)s %(message)s"))
+        raw_logger.addHandler(handler)
+        raw_logger.setLevel(logging.INFO)
+
+
+def dump_raw(kind: str, text: str):
+    """Сохраняет сырой ответ модели в RAW_LOG_PATH (все в DEBUG, иначе выборочно)."""
+    if not raw_logger.handlers:
+        return
+    if LOG_LEVEL == "DEBUG" or random.random() < LOG_SAMPLE_RATE:
+        raw_logger.info("%s\n%s", kind, text)
@@ -0,0 +1,172 @@
+import re
+
+import polars as pl
+
+from modes import schema_for
+
+# Заглушки пустых ячеек: модель пишет null вместо "(пусто)"
+EMPTY = "(пусто)"
+NULL_MARKERS = ["null", "none", EMPTY, "", "-", "—"]
+
+_SEPARATOR_RE = re.compile(r"^\|?\s*:?-+:?\s*(\|\s*:?-+:?\s*)*\|?$")
+
+
+class RowError(ValueError):
+    pass
+
+
+def split_row(line: str, headers: list[str]) -> list[str] | None:
+    """Разбирает одну строку markdown-таблицы.
+
+    Возвращает ячейки строки, None для служебных строк (пустые, ``` ,
+    разделитель, повтор заголовка) или бросает RowError, если число
+    ячеек не совпадает с числом столбцов.
+    """
+    line = line.strip()
+    if not line or line.startswith("```") or _SEPARATOR_RE.match(line):
+        return None
+    # Первая строка ответа продолжает "|" из подсказки и начинается без него
+    if line.startswith("|"):
+        line = line[1:]
+    if line.endswith("|"):
+        line = line[:-1]
+    cells = [cell.strip() for cell in line.split("|")]
+    if cells == [h.strip() for h in headers]:
+        return None
+    if len(cells) != len(headers):
+        raise RowError(f"{len(cells)} ячеек вместо {len(headers)}: {line[:80]}")
+    return cells
+
+
+def _number(column: str, dtype: pl.DataType) -> pl.Expr:
+    """"1 234 567,89", "1.234,5", "1,234.5", "12,5%" -> "1234567.89", "1234.5", "1234.5", "12.5".
+
+    Последний разделитель - десятичный, только если за ним не больше знаков, чем
+    допускает тип (2 для денег, 0 для целых, сколько угодно для долей); иначе это
+    разделитель тысяч, и группы после него должны быть по три цифры. Остальное
+    ("12.345" в деньгах, "1.234.5", "1 234,567") - null, то есть проблема разбора,
+    а не молча обрезанная сумма.
+    """
+    s = pl.col(column).str.replace_all(r"[\s%]", "")
+    if isinstance(dtype, pl.Decimal):
+        fraction = f"{{1,{dtype.scale}}}"
+    elif dtype.is_integer():
+        fraction = None
+    else:
+        fraction = "+"
+    expr = pl.when(s.str.contains(r"^-?\d+$")).then(s)
+    if fraction is not None:
+        expr = expr.when(s.str.contains(rf"^-?\d+[.,]\d{fraction}$")).then(s.str.replace(",", "."))
+    for group, point in ((r"\.", ","), (",", r"\.")):
+        # Целое с разделителем тысяч: "1.234.567", "1,234"
+        expr = expr.when(s.str.contains(rf"^-?\d{{1,3}}({group}\d{{3}})+$")).then(s.str.replace_all(group, ""))
+        if fraction is not None:
+            # Разделитель тысяч и десятичный: "1.234,56", "1,234.56"
+            expr = expr.when(s.str.contains(rf"^-?\d{{1,3}}({group}\d{{3}})+{point}\d{fraction}$")).then(
+                s.str.replace_all(group, "").str.replace(",", ".")
+            )
+    return expr.otherwise(None)
+
+
+def rows_to_frame(rows: list[list[str]], headers: list[str]) -> tuple[pl.DataFrame, list[str]]:
+    """Собирает типизированную таблицу из строк ячеек по схеме режима (modes.COLUMN_TYPES).
+
+    Заглушки пустых ячеек становятся null в числовых столбцах и "(пусто)" в текстовых.
+    Возвращает таблицу и список проблем: значения, которые не удалось разобрать.
+    """
+    schema = schema_for(headers)
+    raw = pl.DataFrame(rows, schema=headers, orient="row") if rows else pl.DataFrame(
+        schema={name: pl.String for name in headers}
+    )
+    is_empty = {name: pl.col(name).str.to_lowercase().is_in(NULL_MARKERS) for name in headers}
+    columns = []
+    for name, dtype in schema.items():
+        if dtype == pl.String:
+            columns.append(
+                pl.when(pl.col(name).str.to_lowercase() == "null")
+                .then(pl.lit(EMPTY))
+                .otherwise(pl.col(name))
+                .alias(name)
+            )
+        else:
+            columns.append(
+                pl.when(is_empty[name])
+                .then(None)
+                .otherwise(_number(name, dtype))
+                .cast(dtype, strict=False)
+                .alias(name)
+            )
+    df = raw.select(columns)
+
+    # Непустые ячейки, которые не превратились в число (в том числе "1 234,567" в деньгах)
+    problems = []
+    numeric = [name for name, dtype in schema.items() if dtype != pl.String]
+    if numeric and rows:
+        bad = raw.with_row_index("__row").select(
+            "__row",
+            *[
+                (~is_empty[name] & df[name].is_null()).alias(name)
+                for name in numeric
+            ],
+        )
+        for row in bad.filter(pl.any_horizontal(numeric)).iter_rows(named=True):
+            for name in numeric:
+                if row[name]:
+                    value = raw[name][row["__row"]]
+                    problems.append(f"строка {row['__row'] + 1}: «{value}» не число или неоднозначные разделители ({name})")
+    return df, problems
+
+
+def parse_markdown_table(text: str, headers: list[str]) -> tuple[pl.DataFrame, list[str]]:
+    """Разбирает ответ модели (markdown-таблицу) сразу в Polars с типами столбцов.
+    Строки с неверным числом ячеек не теряются молча, а попадают в список проблем."""
+    rows = []
+    problems = []
+    for line in text.splitlines():
+        try:
+            cells = split_row(line, headers)
+        except RowError as e:
+            problems.append(str(e))
+            continue
+        if cells is not None:
+            rows.append(cells)
+    df, value_problems = rows_to_frame(rows, headers)
+    return df, problems + value_problems
+
+
+class RowStream:
+    """Разбор markdown-таблицы по мере прихода текста из потока модели:
+    каждая законченная строка сразу превращается в ячейки или в проблему."""
+
+    def __init__(self, headers: list[str]):
+        self.headers = headers
+        self.rows: list[list[str]] = []
+        self.problems: list[str] = []
+        self._buffer = ""
+
+    def _parse_lines(self, lines: list[str]) -> list[list[str]]:
+        new_rows = []
+        for line in lines:
+            try:
+                cells = split_row(line, self.headers)
+            except RowError as e:
+                self.problems.append(str(e))
+                continue
+            if cells is not None:
+                new_rows.append(cells)
+        self.rows.extend(new_rows)
+        return new_rows
+
+    def feed(self, text: str) -> list[list[str]]:
+        """Добавляет кусок ответа, возвращает строки таблицы, законченные в нём."""
+        *lines, self._buffer = (self._buffer + text).split("\n")
+        return self._parse_lines(lines)
+
+    def close(self) -> list[list[str]]:
+        """Разбирает остаток после конца потока."""
+        lines, self._buffer = [self._buffer], ""
+        return self._parse_lines(lines)
+
+    def frame(self) -> tuple[pl.DataFrame, list[str]]:
+        df, value_problems = rows_to_frame(self.rows, self.headers)
+        return df, self.problems + value_problems
@@ -1,7 +1,36 @@
+import io
+from typing import TYPE_CHECKING
+
 import polars as pl
-from openpyxl import Workbook
-from openpyxl.styles import Alignment
-from openpyxl.utils import get_column_letter
+
+from format import FIXED_WIDTHS, LINE_HEIGHT
+from md_table import EMPTY
+
+if TYPE_CHECKING:
+    from openpyxl import Workbook
+
+# Цвет заливки строк, у которых проверка check.validate_ledger нашла замечания
+FLAG_COLOR = "FFF4CCCC"
+
+
+def _max_lengths(table: pl.DataFrame) -> list[int]:
+    """Максимальная длина значения в каждом столбце (с заголовком), одним проходом Polars."""
+    lengths = table.select(
+        pl.all().cast(pl.String).fill_null(EMPTY).str.len_chars().max()
+    ).row(0)
+    return [max(len(name), length or 0) for name, length in zip(table.columns, lengths)]
+
+
+def _line_counts(table: pl.DataFrame) -> list[int]:
+    """Максимальное число строк текста в ячейках каждой строки таблицы."""
+    if table.height == 0:
+        return []
+    return table.select(
+        pl.max_horizontal(
+            pl.all().cast(pl.String).str.count_matches("\n").fill_null(0)
+        )
+        + 1
+    ).to_series().to_list()
 
 
 def merge_tables_to_excel(
@@ -9,9 +38,22 @@ def merge_tables_to_excel(
     useful_table: pl.DataFrame,
     table_name: str,
     width: int = 8,
-) -> Workbook:
+    notes: list[str | None] | None = None,
+) -> "Workbook":
+    """Собирает итоговую книгу за один проход: заголовок, таблица-шапка
+    в два объединённых столбца, пустая строка и основная таблица.
+    Ширина столбцов, перенос текста и высота строк выставляются сразу.
+    notes - замечания по строкам основной таблицы: такие строки заливаются
+    цветом, а текст замечания становится примечанием к первой ячейке."""
+    from openpyxl import Workbook
+    from openpyxl.comments import Comment
+    from openpyxl.styles import Alignment, PatternFill
+    from openpyxl.utils import get_column_letter
+
+    flag_fill = PatternFill(fill_type="solid", start_color=FLAG_COLOR, end_color=FLAG_COLOR)
     wb = Workbook()
     ws = wb.active
+    wrap = Alignment(wrap_text=True)
 
     # Получаем максимальную ширину второй таблицы
     max_columns = len(useful_table.columns)
@@ -20,13 +62,13 @@ def merge_tables_to_excel(
     # Объединяем ячейки для заголовка на всю ширину
     ws.merge_cells(start_row=1, start_column=1, end_row=1, end_column=max_columns)
     ws["A1"] = table_name
-    ws["A1"].alignment = Alignment(horizontal="center")
+    ws["A1"].alignment = Alignment(horizontal="center", wrap_text=True)
 
-    # Записываем данные первой таблицы, центрируя их
+    # Записываем данные первой таблицы
     start_row = 2
-    for row in head_table.rows():
+    head_rows = [(str(row[0]), str(row[1])) for row in head_table.rows()]
+    for left, right in head_rows:
         # Объединяем ячейки для каждой строки первой таблицы
-        print(row[0], row[1])
         ws.merge_cells(
             start_row=start_row,
             start_column=1,
@@ -39,39 +81,58 @@ def merge_tables_to_excel(
             end_row=start_row,
             end_column=width,
         )
-
-        ws.cell(row=start_row, column=1, value=str(row[0]))
-        ws.cell(row=start_row, column=width // 2 + 1, value=str(row[1]))
-        # ws.cell(row=start_row, column=1).alignment = Alignment(horizontal="center")
-        # ws.cell(row=start_row, column=2).alignment = Alignment(horizontal="center")
+        ws.cell(row=start_row, column=1, value=left).alignment = wrap
+        ws.cell(row=start_row, column=width // 2 + 1, value=right).alignment = wrap
         start_row += 1
 
     # Добавляем пустую строку между таблицами
     start_row += 1
+    header_row = start_row
 
-    # Записываем вторую таблицу
-    # Записываем заголовки
+    # Записываем вторую таблицу: заголовки и данные
     for col_idx, col_name in enumerate(useful_table.columns, 1):
-        ws.cell(row=start_row, column=col_idx, value=col_name)
-
-    # Записываем данные
+        ws.cell(row=header_row, column=col_idx, value=col_name).alignment = wrap
     for row_idx, row in enumerate(useful_table.rows(), 1):
         for col_idx, value in enumerate(row, 1):
-            ws.cell(row=start_row + row_idx, column=col_idx, value=value)
-
-    # Автоподбор ширины столбцов
-    for column in ws.columns:
-        max_length = 0
-        column = list(column)
-        for cell in column:
-            try:
-                if len(str(cell.value)) > max_length:
-                    max_length = len(str(cell.value))
-            except Exception as e:
-                print(e)
-                pass
-        adjusted_width = max_length + 2
-        ws.column_dimensions[get_column_letter(column[0].column)].width = adjusted_width
+            # Пустые числовые ячейки в книге помечаются так же, как текстовые
+            value = EMPTY if value is None else value
+            ws.cell(row=header_row + row_idx, column=col_idx, value=value).alignment = wrap
+        note = notes[row_idx - 1] if notes else None
+        if note:
+            for cell in ws[header_row + row_idx]:
+                cell.fill = flag_fill
+            ws.cell(row=header_row + row_idx, column=1).comment = Comment(note, "Проверка")
+
+    # Ширина столбцов: первые - фиксированные, остальные - по самому длинному значению
+    column_widths = dict(enumerate(_max_lengths(useful_table), 1))
+    extra = {1: [table_name] + [left for left, _ in head_rows], width // 2 + 1: [right for _, right in head_rows]}
+    for col, values in extra.items():
+        column_widths[col] = max([column_widths.get(col, 0)] + [len(v) for v in values])
+    for col, length in column_widths.items():
+        if length:
+            ws.column_dimensions[get_column_letter(col)].width = FIXED_WIDTHS.get(col, length / 2)
+
+    # Высота строк основной таблицы по числу строк текста в ячейках
+    header_lines = max(name.count("\n") + 1 for name in useful_table.columns)
+    for row, lines in enumerate([header_lines] + _line_counts(useful_table), header_row):
+        if lines > 1:
+            ws.row_dimensions[row].height = lines * LINE_HEIGHT
 
     return wb
 
+
+def workbook_to_bytes(wb: "Workbook") -> bytes:
+    buffer = io.BytesIO()
+    wb.save(buffer)
+    return buffer.getvalue()
+
+
+def build_workbook_bytes(
+    head_table: pl.DataFrame,
+    useful_table: pl.DataFrame,
+    table_name: str,
+    width: int = 8,
+    notes: list[str | None] | None = None,
+) -> bytes:
+    """merge_tables_to_excel + workbook_to_bytes одной функцией - для пула процессов."""
+    return workbook_to_bytes(merge_tables_to_excel(head_table, useful_table, table_name, width, notes))
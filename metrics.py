@@ -0,0 +1,182 @@
+import json
+import logging
+import os
+import time
+from collections import Counter, defaultdict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Метрики в формате Prometheus на http://METRICS_HOST:METRICS_PORT/metrics (0 - выключено)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", 9108))
+# Сколько последних замеров каждого этапа хранится для p50/p95 в /stats
+METRICS_WINDOW = int(os.getenv("METRICS_WINDOW", 500))
+PREFIX = "exceltelegram"
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+
+class LatencyHistogram:
+    """Скользящее окно последних задержек в секундах."""
+
+    def __init__(self, window: int = METRICS_WINDOW):
+        self.samples: deque[float] = deque(maxlen=window)
+
+    def add(self, seconds: float):
+        self.samples.append(seconds)
+
+    def percentile(self, q: float) -> float | None:
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * q / 100))]
+
+
+class StageHistogram:
+    """Гистограмма длительностей этапа для Prometheus и окно последних замеров."""
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+        self.recent = LatencyHistogram()
+
+    def observe(self, seconds: float):
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.buckets[i] += 1
+        self.sum += seconds
+        self.count += 1
+        self.recent.add(seconds)
+
+
+STAGES: dict[str, StageHistogram] = defaultdict(StageHistogram)
+# Счётчики: (имя, метки) -> значение
+COUNTERS: Counter = Counter()
+# Счётчик текущего альбома; задачи asyncio наследуют его от album_metrics
+_album: ContextVar[Counter | None] = ContextVar("album_metrics", default=None)
+
+
+def inc(name: str, value: float = 1, **labels: str):
+    COUNTERS[(name, tuple(sorted(labels.items())))] += value
+    album = _album.get()
+    if album is not None:
+        album["_".join([name, *(str(v) for _, v in sorted(labels.items()))])] += value
+
+
+def observe(stage: str, seconds: float):
+    STAGES[stage].observe(seconds)
+    album = _album.get()
+    if album is not None:
+        album[f"{stage}_s"] += seconds
+        album[f"{stage}_n"] += 1
+
+
+@contextmanager
+def span(stage: str):
+    """Замеряет длительность блока как этап stage."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start)
+
+
+def record_usage(provider: str, usage):
+    """Токены из ответа OpenAI/Mistral (поле usage) - основа стоимости запроса."""
+    inc("llm_calls", provider=provider)
+    if usage is None:
+        return
+    inc("llm_tokens", getattr(usage, "prompt_tokens", 0) or 0, provider=provider, kind="prompt")
+    inc("llm_tokens", getattr(usage, "completion_tokens", 0) or 0, provider=provider, kind="completion")
+
+
+@contextmanager
+def album_metrics(**fields):
+    """Собирает этапы и счётчики одного альбома и пишет их одной строкой лога."""
+    album = Counter()
+    token = _album.set(album)
+    start = time.perf_counter()
+    try:
+        yield album
+    finally:
+        _album.reset(token)
+        total = time.perf_counter() - start
+        STAGES["album"].observe(total)
+        summary = {**fields, "total_s": total, **dict(sorted(album.items()))}
+        logger.info(
+            "album_summary %s",
+            json.dumps({k: round(v, 3) if isinstance(v, float) else v for k, v in summary.items()}, ensure_ascii=False),
+        )
+
+
+def _labels(pairs) -> str:
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+
+def render() -> str:
+    """Все метрики в текстовом формате Prometheus."""
+    lines = [
+        f"# HELP {PREFIX}_stage_seconds Длительность этапов обработки альбома",
+        f"# TYPE {PREFIX}_stage_seconds histogram",
+    ]
+    for stage, histogram in sorted(STAGES.items()):
+        for bound, count in zip(BUCKETS, histogram.buckets):
+            lines.append(f'{PREFIX}_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {count}')
+        lines.append(f'{PREFIX}_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+        lines.append(f'{PREFIX}_stage_seconds_sum{{stage="{stage}"}} {histogram.sum}')
+        lines.append(f'{PREFIX}_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+    by_name = defaultdict(list)
+    for (name, labels), value in sorted(COUNTERS.items()):
+        by_name[name].append((labels, value))
+    for name, values in by_name.items():
+        lines.append(f"# TYPE {PREFIX}_{name}_total counter")
+        for labels, value in values:
+            lines.append(f"{PREFIX}_{name}_total{_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def stats_text() -> str:
+    """p50/p95 последних замеров по этапам - для команды /stats."""
+    lines = []
+    for stage, histogram in sorted(STAGES.items()):
+        p50 = histogram.recent.percentile(50)
+        p95 = histogram.recent.percentile(95)
+        if p50 is not None:
+            lines.append(f"{stage}: p50 {p50:.2f}s, p95 {p95:.2f}s, замеров {histogram.count}")
+    tokens = Counter()
+    for (name, labels), value in COUNTERS.items():
+        if name == "llm_tokens":
+            tokens[dict(labels)["provider"]] += value
+    lines.extend(f"токены {provider}: {int(value)}" for provider, value in sorted(tokens.items()))
+    return "\n".join(lines) or "Замеров пока нет"
+
+
+_runner: web.AppRunner | None = None
+
+
+async def _metrics_handler(_request: web.Request) -> web.Response:
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+async def start_metrics_server():
+    global _runner
+    if METRICS_PORT == 0 or _runner is not None:
+        return
+    app = web.Application()
+    app.router.add_get("/metrics", _metrics_handler)
+    _runner = web.AppRunner(app)
+    await _runner.setup()
+    await web.TCPSite(_runner, METRICS_HOST, METRICS_PORT).start()
+
+
+async def stop_metrics_server():
+    global _runner
+    if _runner is not None:
+        await _runner.cleanup()
+        _runner = None
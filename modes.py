@@ -0,0 +1,42 @@
+import polars as pl
+
+HEADERS = {
+    "SALES_HEADERS": [
+        "№ п/п",
+        "ИНН",
+        "Наименование",
+        "Счета-фактуры",
+        "Стоимость продаж с НДС в руб. и коп. (стр. 160)",
+        "Стоимость продаж облагаемых налогом всего (без суммы НДС, стр. 170 + 175 + 180 + 190)",
+        "Сумма НДС всего (стр. 200 + 210)",
+        "Доля продаж (стр. 160 + 220)",
+    ],
+    "SHOP_HEADERS": [
+        "№ п/п",
+        "ИНН",
+        "Наименование",
+        "Счета-фактуры",
+        "Стоимость покупок с НДС (стр. 170)",
+        "Сумма НДС (стр. 180)",
+        "Удельный вес вычетов",
+    ],
+}
+
+MONEY = pl.Decimal(precision=18, scale=2)
+PERCENT = pl.Float64
+
+# Типы столбцов при разборе ответа модели, остальные столбцы - строки
+COLUMN_TYPES = {
+    "№ п/п": pl.Int64,
+    "Стоимость продаж с НДС в руб. и коп. (стр. 160)": MONEY,
+    "Стоимость продаж облагаемых налогом всего (без суммы НДС, стр. 170 + 175 + 180 + 190)": MONEY,
+    "Сумма НДС всего (стр. 200 + 210)": MONEY,
+    "Доля продаж (стр. 160 + 220)": PERCENT,
+    "Стоимость покупок с НДС (стр. 170)": MONEY,
+    "Сумма НДС (стр. 180)": MONEY,
+    "Удельный вес вычетов": PERCENT,
+}
+
+
+def schema_for(headers: list[str]) -> dict[str, pl.DataType]:
+    return {name: COLUMN_TYPES.get(name, pl.String) for name in headers}
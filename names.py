@@ -0,0 +1,105 @@
+import re
+
+import polars as pl
+
+# Организационно-правовые формы: при сравнении названий не учитываются
+LEGAL_FORMS = [
+    "общество с ограниченной ответственностью",
+    "публичное акционерное общество",
+    "непубличное акционерное общество",
+    "закрытое акционерное общество",
+    "открытое акционерное общество",
+    "акционерное общество",
+    "индивидуальный предприниматель",
+    "крестьянское фермерское хозяйство",
+    "ооо",
+    "пао",
+    "нао",
+    "зао",
+    "оао",
+    "ао",
+    "ип",
+    "кфх",
+    "гуп",
+    "муп",
+    "фгуп",
+    "ано",
+    "нко",
+]
+_LEGAL_FORMS_RE = r"\b(?:" + "|".join(LEGAL_FORMS) + r")\b"
+# Полные названия форм - к сокращению, как в ответах Dadata (opf.short)
+SHORT_FORMS = {
+    "общество с ограниченной ответственностью": "ооо",
+    "публичное акционерное общество": "пао",
+    "непубличное акционерное общество": "нао",
+    "закрытое акционерное общество": "зао",
+    "открытое акционерное общество": "оао",
+    "акционерное общество": "ао",
+    "индивидуальный предприниматель": "ип",
+    "крестьянское фермерское хозяйство": "кфх",
+}
+
+
+def normalize_names(names: list[str]) -> list[str]:
+    """Приводит названия к виду для сравнения: нижний регистр, ё -> е,
+    без кавычек, знаков препинания и организационно-правовой формы."""
+    return (
+        pl.Series(names, dtype=pl.String)
+        .fill_null("")
+        .str.to_lowercase()
+        .str.replace_all("ё", "е")
+        .str.replace_all(r"[«»\"'“”„`.,;:()]", " ")
+        .str.replace_all(_LEGAL_FORMS_RE, " ")
+        .str.replace_all(r"\s+", " ")
+        .str.strip_chars()
+        .to_list()
+    )
+
+
+def legal_form(name: str) -> str:
+    """Сокращённая организационно-правовая форма из названия ("ООО") или ""."""
+    match = re.search(_LEGAL_FORMS_RE, (name or "").lower().replace("ё", "е"))
+    if match is None:
+        return ""
+    return SHORT_FORMS.get(match.group(0), match.group(0)).upper()
+
+
+def match_names(
+    org_names: list[str], candidates: list[list[str]]
+) -> list[tuple[str, float]]:
+    """Для каждого распознанного названия выбирает самое похожее из своих кандидатов.
+
+    Все названия нормализуются один раз, похожесть (fuzz.ratio, 0-100) считается
+    одной матрицей "уникальные названия x уникальные кандидаты". Для строк без
+    кандидатов возвращается ("", 0).
+    """
+    import numpy as np
+    from rapidfuzz import fuzz, process
+
+    result = [("", 0.0)] * len(org_names)
+    lengths = np.array([len(c) for c in candidates], dtype=np.int64)
+    flat = [name for names in candidates for name in names]
+    if not flat:
+        return result
+
+    queries = normalize_names(org_names)
+    choices = normalize_names(flat)
+    unique_queries = list(dict.fromkeys(queries))
+    unique_choices = list(dict.fromkeys(choices))
+    matrix = process.cdist(unique_queries, unique_choices, scorer=fuzz.ratio, workers=-1)
+
+    query_pos = {q: i for i, q in enumerate(unique_queries)}
+    choice_pos = {c: i for i, c in enumerate(unique_choices)}
+    rows = np.repeat(np.arange(len(org_names)), lengths)
+    scores = matrix[
+        np.array([query_pos[q] for q in queries])[rows],
+        np.array([choice_pos[c] for c in choices]),
+    ]
+    # Лучший кандидат каждой строки: сортируем по (строка, -оценка), берём первый
+    order = np.lexsort((-scores, rows))
+    first = np.unique(rows[order], return_index=True)[1]
+    best = order[first]
+    for flat_idx in best:
+        row = rows[flat_idx]
+        result[row] = (flat[flat_idx], float(scores[flat_idx]))
+    return result
@@ -0,0 +1,89 @@
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter
+
+import polars as pl
+
+OCR_CACHE_PATH = os.getenv("OCR_CACHE_PATH", "ocr_cache.sqlite3")
+OCR_CACHE_MAX_MB = float(os.getenv("OCR_CACHE_MAX_MB", 200))
+
+
+def ocr_key(kind: str, model: str, prompt_version: str, base64_image: str, headers: list[str] = ()) -> str:
+    """Ключ результата распознавания: хэш фото + набор заголовков + модель + версия промпта."""
+    h = hashlib.sha256()
+    for part in (kind, model, prompt_version, "\x1f".join(headers), base64_image):
+        h.update(part.encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()
+
+
+class OcrCache:
+    """Локальный кэш разобранных ответов LLM в SQLite: таблица в формате Arrow IPC,
+    название (для шапки) и проблемы разбора - при попадании они сообщаются
+    пользователю снова, как при первом распознавании. При превышении max_mb вытесняются давно не
+    использованные записи."""
+
+    def __init__(self, path: str = OCR_CACHE_PATH, max_mb: float = OCR_CACHE_MAX_MB):
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(results)")]
+        if columns and "problems" not in columns:
+            # Старые записи сохранены без проблем разбора - такой кэш молча их теряет
+            self._conn.execute("DROP TABLE results")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            "key TEXT PRIMARY KEY, name TEXT NOT NULL, payload BLOB NOT NULL, "
+            "size INTEGER NOT NULL, last_used REAL NOT NULL, problems TEXT NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS results_last_used ON results (last_used)"
+        )
+        self._conn.commit()
+
+    def get(self, key: str, stats: Counter | None = None) -> tuple[pl.DataFrame, str, list[str]] | None:
+        """(таблица, название, проблемы разбора) или None."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT payload, name, problems FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                self._conn.execute(
+                    "UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key)
+                )
+                self._conn.commit()
+            if stats is not None:
+                stats["hits" if row is not None else "misses"] += 1
+        if row is None:
+            return None
+        return pl.read_ipc(io.BytesIO(row[0])), row[1], json.loads(row[2])
+
+    def put(self, key: str, df: pl.DataFrame, name: str = "", problems: list[str] = ()):
+        buffer = io.BytesIO()
+        df.write_ipc(buffer)
+        payload = buffer.getvalue()
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+                (key, name, payload, len(payload), time.time(), json.dumps(list(problems), ensure_ascii=False)),
+            )
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        (total,) = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()
+        if total <= self.max_bytes:
+            return
+        freed = 0
+        for key, size in self._conn.execute(
+            "SELECT key, size FROM results ORDER BY last_used"
+        ).fetchall():
+            self._conn.execute("DELETE FROM results WHERE key = ?", (key,))
+            freed += size
+            if total - freed <= self.max_bytes:
+                break
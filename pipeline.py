@@ -0,0 +1,157 @@
+import asyncio
+import os
+from collections import Counter
+from dataclasses import dataclass, field
+
+import polars as pl
+
+from async_app import get_head_async
+from cpu import run_cpu
+from images import AlbumImages, read_image, split_bands
+from router import default_extractor
+from stitch import stitch_bands, stitch_pages
+from inn_check import fetch_suggestions_async, repair_inns_async
+
+
+# Режим полос: длинная страница режется на TILE_BANDS перекрывающихся
+# горизонтальных полос, которые распознаются параллельно (1 - выключено)
+TILE_BANDS = int(os.getenv("TILE_BANDS", 1))
+TILE_OVERLAP = float(os.getenv("TILE_OVERLAP", 0.06))
+
+
+def _first_error(error: BaseException) -> BaseException:
+    """Первая ошибка из (вложенных) групп TaskGroup - наружу она уходит как раньше
+    из asyncio.gather, и бот сообщает "Ошибка: ..." по ней."""
+    while isinstance(error, BaseExceptionGroup):
+        error = error.exceptions[0]
+    return error
+
+
+@dataclass
+class AlbumResult:
+    head_table: pl.DataFrame
+    head_name: str
+    table: pl.DataFrame
+    # Ответы Dadata по ИНН всех страниц - передаются в check_by_inn
+    suggestions: dict[str, list[dict]]
+    # Сводка по подготовке фото: размеры запросов и время кодирования
+    images_summary: str
+    # Попадания и промахи кэша ИНН за альбом
+    inn_stats: Counter = field(default_factory=Counter)
+    # Попадания и промахи кэша OCR (шапка и страницы)
+    ocr_stats: Counter = field(default_factory=Counter)
+    # Строки и значения, которые не удалось разобрать из ответа модели
+    parse_problems: list[str] = field(default_factory=list)
+    # Сколько повторов между страницами удалено и какие номера "№ п/п" пропущены
+    duplicates_dropped: int = 0
+    missing_numbers: list[tuple[int, int]] = field(default_factory=list)
+    # ИНН, исправленные по контрольной сумме: (название, старый ИНН, новый ИНН)
+    inn_repairs: list[tuple[str, str, str]] = field(default_factory=list)
+
+
+async def extract_tiled(
+    image: str | bytes, headers: list[str], extractor, images: AlbumImages, **kwargs
+) -> pl.DataFrame:
+    """Распознаёт страницу по полосам параллельно и склеивает строки.
+    Контекст столбцов у каждой полосы свой: строка заголовков подставляется в промпт."""
+    bands = await run_cpu(split_bands, read_image(image), TILE_BANDS, TILE_OVERLAP)
+
+    async def run(band: bytes) -> pl.DataFrame:
+        return await extractor(await images.prepare(band), headers, **kwargs)
+
+    # TaskGroup, а не gather: при ошибке одной полосы остальные отменяются
+    async with asyncio.TaskGroup() as group:
+        tasks = [group.create_task(run(band)) for band in bands]
+    return stitch_bands([task.result() for task in tasks])
+
+
+async def process_album(
+    count: int,
+    download,
+    headers: list[str],
+    on_page=None,
+    on_head=None,
+    extractor=None,
+) -> AlbumResult:
+    """Конвейер обработки альбома из count фотографий.
+
+    Для каждой страницы своя цепочка: скачивание -> распознавание -> запросы
+    в Dadata по ИНН этой страницы. Цепочки идут параллельно, шапка извлекается
+    сразу после скачивания первой фотографии, одновременно с первой страницей.
+    Итоговое время - примерно самая медленная цепочка, а не сумма этапов.
+    Если одна цепочка падает, остальные (и их запросы в Dadata) отменяются,
+    чтобы не занимать LLM_SEMAPHORE, нужный альбомам других пользователей.
+
+    download(i) - корутина, возвращающая i-ю фотографию (байты или путь) для OCR.
+    on_page(i, df) и on_head(table, name) - необязательные async-колбэки.
+    extractor - распознавание страницы, по умолчанию Mistral или роутер
+    с хеджированием между провайдерами (OCR_HEDGING=1).
+    """
+    extractor = extractor or default_extractor()
+    # Первое фото нужно и шапке, и странице - кодируется один раз
+    images = AlbumImages()
+    suggestions: dict[str, list[dict]] = {}
+    inn_stats = Counter()
+    inn_repairs = []
+    ocr_stats = Counter()
+    parse_problems = []
+
+    async def head_chain() -> tuple[pl.DataFrame, str]:
+        head_table, head_name = await get_head_async(
+            # Шапка - над таблицей, обрезка до таблицы её бы отрезала
+            await images.prepare(await downloads[0], crop=False), stats=ocr_stats
+        )
+        if on_head is not None:
+            await on_head(head_table, head_name)
+        return head_table, head_name
+
+    async def page_chain(i: int) -> pl.DataFrame:
+        page_problems = []
+        prefetch = []
+
+        async def on_rows(rows: pl.DataFrame):
+            # В потоковом режиме ИНН готовых строк уходят в Dadata, пока страница ещё генерируется
+            inns = [inn for inn in rows[rows.columns[1]].to_list() if inn not in suggestions]
+            if inns:
+                prefetch.append(group.create_task(fetch_suggestions_async(inns, inn_stats)))
+
+        kwargs = dict(stats=ocr_stats, problems=page_problems, on_rows=on_rows)
+        if TILE_BANDS > 1:
+            df = await extract_tiled(await downloads[i], headers, extractor, images, **kwargs)
+        else:
+            df = await extractor(await images.prepare(await downloads[i]), headers, **kwargs)
+        for prefetched in await asyncio.gather(*prefetch):
+            suggestions.update(prefetched)
+        parse_problems.extend(f"Страница {i + 1}, {problem}" for problem in page_problems)
+        if on_page is not None:
+            await on_page(i, df)
+        # ИНН с ошибкой распознавания чиним до запросов по странице
+        df, repairs, repaired_suggestions = await repair_inns_async(df, inn_stats)
+        inn_repairs.extend(repairs)
+        suggestions.update(repaired_suggestions)
+        inns = [inn for inn in df[df.columns[1]].to_list() if inn not in suggestions]
+        suggestions.update(await fetch_suggestions_async(inns, inn_stats))
+        return df
+
+    try:
+        async with asyncio.TaskGroup() as group:
+            downloads = [group.create_task(download(i)) for i in range(count)]
+            head = group.create_task(head_chain())
+            pages = [group.create_task(page_chain(i)) for i in range(count)]
+    except BaseExceptionGroup as e:
+        raise _first_error(e)
+    head_table, head_name = head.result()
+    table, dropped, missing = stitch_pages([page.result() for page in pages])
+    return AlbumResult(
+        head_table=head_table,
+        head_name=head_name,
+        table=table,
+        suggestions=suggestions,
+        images_summary=images.summary(),
+        inn_stats=inn_stats,
+        ocr_stats=ocr_stats,
+        parse_problems=parse_problems,
+        duplicates_dropped=dropped,
+        missing_numbers=missing,
+        inn_repairs=inn_repairs,
+    )
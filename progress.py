@@ -0,0 +1,86 @@
+import asyncio
+import logging
+import os
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+
+from inn_check import MESSAGE_LIMIT
+
+logger = logging.getLogger(__name__)
+
+# Статус альбома правится не чаще раза в PROGRESS_INTERVAL секунд
+PROGRESS_INTERVAL = float(os.getenv("PROGRESS_INTERVAL", 3))
+
+
+class ProgressMessage:
+    """Одно сообщение со статусом альбома вместо отдельного сообщения на каждый шаг.
+
+    set(key, text) меняет строку статуса; правки копятся и уходят в Telegram
+    одной редакцией не чаще PROGRESS_INTERVAL, finish() отправляет итог сразу.
+    """
+
+    def __init__(self, bot: Bot, chat_id: int, interval: float = PROGRESS_INTERVAL):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.interval = interval
+        self.lines: dict[str, str] = {}
+        self._message_id: int | None = None
+        self._sent = ""
+        self._last_edit = 0.0
+        self._pending: asyncio.Task | None = None
+
+    def text(self) -> str:
+        return "\n".join(self.lines.values())[:MESSAGE_LIMIT]
+
+    async def start(self, **lines: str):
+        self.lines.update(lines)
+        self._sent = self.text()
+        message = await self.bot.send_message(self.chat_id, self._sent)
+        self._message_id = message.message_id
+        self._last_edit = time.monotonic()
+
+    def set(self, key: str, text: str):
+        self.lines[key] = text
+        if self._pending is None or self._pending.done():
+            self._pending = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(max(0.0, self._last_edit + self.interval - time.monotonic()))
+        await self._flush()
+
+    async def _flush(self):
+        text = self.text()
+        if self._message_id is None or text == self._sent:
+            return
+        try:
+            try:
+                await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self._message_id)
+            except TelegramRetryAfter as e:
+                await asyncio.sleep(e.retry_after)
+                await self.bot.edit_message_text(text, chat_id=self.chat_id, message_id=self._message_id)
+        except TelegramAPIError as e:
+            # Повторный flood control, "message is not modified", сбой сети и подобное -
+            # статус не важнее результата и не должен подменять ошибку альбома
+            # (а в фоновом _flush_later - пропадать незамеченным)
+            logger.warning("progress edit failed: %s", e)
+        self._sent = text
+        self._last_edit = time.monotonic()
+
+    async def finish(self, **lines: str):
+        self.lines.update(lines)
+        if self._pending is not None:
+            self._pending.cancel()
+        await self._flush()
+
+
+def pack_messages(chunks: list[str], limit: int = MESSAGE_LIMIT) -> list[str]:
+    """Склеивает подряд идущие куски в сообщения не длиннее limit."""
+    messages = []
+    for chunk in chunks:
+        if messages and len(messages[-1]) + 1 + len(chunk) <= limit:
+            messages[-1] += "\n" + chunk
+        else:
+            messages.append(chunk)
+    return messages
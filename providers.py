@@ -0,0 +1,92 @@
+"""Клиенты внешних API создаются при первом обращении, а не при импорте.
+
+Импорт бота не тянет SDK OpenAI, Mistral и Dadata и не требует ключей:
+клиент появляется в get(name), отсутствующий ключ - ошибка первого запроса.
+prewarm() заранее импортирует тяжёлые библиотеки и создаёт клиентов -
+бот вызывает его в фоне, когда опрос Telegram уже запущен.
+"""
+import importlib
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+_factories: dict[str, callable] = {}
+_instances: dict[str, object] = {}
+_lock = threading.Lock()
+
+# Библиотеки горячего пути, которые импортируются лениво: pandas и lxml - в
+# async_app._parse_head, openpyxl - в merge, Pillow и numpy - в images,
+# rapidfuzz и numpy - в names и registry
+PREWARM_MODULES = ["pandas", "lxml.html", "openpyxl", "PIL.Image", "numpy", "rapidfuzz.process"]
+
+
+def provider(name: str):
+    """Регистрирует фабрику клиента name."""
+
+    def register(factory):
+        _factories[name] = factory
+        return factory
+
+    return register
+
+
+def get(name: str):
+    client = _instances.get(name)
+    if client is None:
+        with _lock:
+            client = _instances.get(name)
+            if client is None:
+                client = _instances[name] = _factories[name]()
+    return client
+
+
+def drop(name: str):
+    """Забывает клиента name и возвращает его (None, если он не создавался)."""
+    with _lock:
+        return _instances.pop(name, None)
+
+
+def require_env(name: str) -> str:
+    value = os.getenv(name)
+    if not value:
+        raise RuntimeError(f"Не задана переменная окружения {name}")
+    return value
+
+
+@provider("openai")
+def _openai():
+    from openai import OpenAI
+
+    return OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+
+
+@provider("openai_async")
+def _openai_async():
+    from openai import AsyncOpenAI
+
+    return AsyncOpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
+
+
+@provider("mistral")
+def _mistral():
+    # Клиент Mistral умеет и sync, и async (chat.complete_async).
+    # MISTRAL_SERVER_URL (как и OPENAI_BASE_URL у OpenAI) - другой адрес API, например стенд bench.py
+    from mistralai import Mistral
+
+    return Mistral(api_key=os.getenv("MISTRAL_API_KEY"), server_url=os.getenv("MISTRAL_SERVER_URL"))
+
+
+def prewarm(names: list[str] | None = None):
+    """Импортирует PREWARM_MODULES и создаёт клиентов (по умолчанию всех)."""
+    start = time.perf_counter()
+    for module in PREWARM_MODULES:
+        importlib.import_module(module)
+    for name in names or list(_factories):
+        try:
+            get(name)
+        except Exception as e:
+            logger.warning("prewarm %s failed: %s", name, e)
+    logger.info("providers prewarmed in %.2fs", time.perf_counter() - start)
@@ -0,0 +1,223 @@
+"""Локальный реестр контрагентов: ИНН, каноническое название и правовая форма.
+
+Пополняется ответами Dadata (inn_check) и выгрузками CSV, хранится в SQLite.
+Поиск по названию идёт по триграммному инвертированному индексу в памяти:
+неверный или пустой ИНН строки восстанавливается по названию без сети.
+
+    python registry.py load counterparties.csv      # столбцы inn, name[, legal_form]
+    python registry.py find 'ООО "Ромашка"'
+"""
+import argparse
+import csv
+import os
+import sqlite3
+import threading
+import time
+from collections import Counter, defaultdict
+
+from inn_validate import valid_inns
+from names import legal_form, normalize_names
+
+REGISTRY_PATH = os.getenv("REGISTRY_PATH", "registry.sqlite3")
+# Наименьшая похожесть названий (fuzz.ratio, 0-100), при которой ИНН берётся из реестра
+REGISTRY_MIN_SIMILARITY = float(os.getenv("REGISTRY_MIN_SIMILARITY", 90))
+# Сколько вхождений самых редких триграмм запроса просматривается при отборе кандидатов
+REGISTRY_POSTINGS = int(os.getenv("REGISTRY_POSTINGS", 5000))
+# Сколько кандидатов с наибольшим числом общих редких триграмм сравнивается с запросом
+REGISTRY_CANDIDATES = int(os.getenv("REGISTRY_CANDIDATES", 50))
+
+
+def trigrams(normalized: str) -> set[str]:
+    padded = f"  {normalized} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class Registry:
+    """Контрагенты по ИНН в SQLite и триграммный индекс их названий.
+
+    Индекс строится из базы при первом поиске (или load()) и дальше обновляется
+    вместе с ней. База и индекс под разными блокировками: пока строится индекс,
+    get() и add() не ждут.
+    """
+
+    def __init__(self, path: str = REGISTRY_PATH):
+        self._lock = threading.Lock()
+        self._index_lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS counterparties ("
+            "inn TEXT PRIMARY KEY, name TEXT NOT NULL, legal_form TEXT NOT NULL, "
+            "source TEXT NOT NULL, updated REAL NOT NULL)"
+        )
+        self._conn.commit()
+        # ИНН -> (нормализованное название, форма); нормализованное название
+        # и триграмма -> ИНН с ними
+        self._names: dict[str, tuple[str, str]] | None = None
+        self._exact: defaultdict[str, set[str]] = defaultdict(set)
+        self._index: defaultdict[str, set[str]] = defaultdict(set)
+
+    def load(self):
+        with self._index_lock:
+            self._load()
+
+    def _load(self):
+        if self._names is not None:
+            return
+        with self._lock:
+            rows = self._conn.execute("SELECT inn, name, legal_form FROM counterparties").fetchall()
+        self._names = {}
+        self._index_rows(rows)
+
+    def _index_rows(self, rows: list[tuple[str, str, str]]):
+        for (inn, _, form), normalized in zip(rows, normalize_names([row[1] for row in rows])):
+            old = self._names.get(inn)
+            if old is not None:
+                self._exact[old[0]].discard(inn)
+                for gram in trigrams(old[0]):
+                    self._index[gram].discard(inn)
+            self._names[inn] = (normalized, form.upper())
+            self._exact[normalized].add(inn)
+            for gram in trigrams(normalized):
+                self._index[gram].add(inn)
+
+    def add(self, rows: list[tuple[str, str, str]], source: str):
+        """Записывает (ИНН, название, форма); ИНН с неверной контрольной суммой пропускаются."""
+        valid = set(valid_inns([inn for inn, _, _ in rows]))
+        rows = [(inn, name, form or legal_form(name)) for inn, name, form in rows if inn in valid and name]
+        if not rows:
+            return 0
+        now = time.time()
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO counterparties VALUES (?, ?, ?, ?, ?)",
+                [(inn, name, form, source, now) for inn, name, form in rows],
+            )
+            self._conn.commit()
+        with self._index_lock:
+            if self._names is not None:
+                self._index_rows(rows)
+        return len(rows)
+
+    def add_suggestions(self, suggestions: list[dict]):
+        """Запоминает организации из ответа Dadata suggest("party", ...)."""
+        rows = []
+        for item in suggestions:
+            data = item.get("data") or {}
+            if data.get("inn") and item.get("value"):
+                opf = data.get("opf") or {}
+                rows.append((data["inn"], item["value"], opf.get("short") or ""))
+        self.add(rows, "dadata")
+
+    def get(self, inn: str) -> tuple[str, str] | None:
+        """(название, форма) по ИНН или None."""
+        with self._lock:
+            return self._conn.execute(
+                "SELECT name, legal_form FROM counterparties WHERE inn = ?", (inn,)
+            ).fetchone()
+
+    def suggestions(self, inn: str) -> list[dict]:
+        """Запись реестра в виде ответа Dadata - для тех же проверок названий."""
+        known = self.get(inn)
+        if known is None:
+            return []
+        name, form = known
+        return [{"value": name, "data": {"inn": inn, "opf": {"short": form}}}]
+
+    def _form_matches(self, form: str, inn: str) -> bool:
+        candidate_form = self._names[inn][1]
+        return not (form and candidate_form and form != candidate_form)
+
+    def search(self, names: list[str], limit: int = 1) -> list[list[tuple[str, float]]]:
+        """Для каждого названия - до limit пар (ИНН, похожесть) по убыванию похожести.
+        Совпадение нормализованного названия целиком находится сразу, по словарю.
+
+        Общие триграммы считаются только по самым редким триграммам запроса
+        (до REGISTRY_POSTINGS вхождений): у верного названия с опечаткой большая
+        часть триграмм совпадает, а частые (" ст", "ой ") почти ничего не отсеивают.
+        Названия другой правовой формы (ООО против ИП) не предлагаются.
+        """
+        from rapidfuzz import fuzz, process
+
+        with self._index_lock:
+            self._load()
+            results = []
+            for name, normalized in zip(names, normalize_names(names)):
+                form = legal_form(name)
+                exact = [inn for inn in self._exact.get(normalized, ()) if self._form_matches(form, inn)]
+                if exact or not normalized:
+                    results.append([(inn, 100.0) for inn in exact[:limit]])
+                    continue
+                postings = sorted(
+                    (self._index[gram] for gram in trigrams(normalized) if gram in self._index),
+                    key=len,
+                )
+                shared = Counter()
+                visited = 0
+                for posting in postings:
+                    if visited and visited + len(posting) > REGISTRY_POSTINGS:
+                        break
+                    shared.update(posting)
+                    visited += len(posting)
+                choices = {
+                    inn: self._names[inn][0]
+                    for inn, _ in shared.most_common(REGISTRY_CANDIDATES)
+                    if self._form_matches(form, inn)
+                }
+                matches = process.extract(normalized, choices, scorer=fuzz.ratio, limit=limit)
+                results.append([(inn, similarity) for _, similarity, inn in matches])
+        return results
+
+    def resolve(self, names: list[str]) -> list[str | None]:
+        """ИНН для каждого названия или None, если похожего нет или подходят
+        несколько разных организаций сразу."""
+        resolved = []
+        for matches in self.search(names, limit=2):
+            good = [inn for inn, similarity in matches if similarity >= REGISTRY_MIN_SIMILARITY]
+            resolved.append(good[0] if len(good) == 1 else None)
+        return resolved
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM counterparties").fetchone()[0]
+
+
+def load_csv(registry: Registry, path: str, delimiter: str = ",") -> tuple[int, int]:
+    """Загружает выгрузку CSV со столбцами inn, name и необязательным legal_form.
+    Возвращает (записано, пропущено)."""
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        rows = [
+            ((row.get("inn") or "").strip(), (row.get("name") or "").strip(), (row.get("legal_form") or "").strip())
+            for row in csv.DictReader(f, delimiter=delimiter)
+        ]
+    written = registry.add(rows, os.path.basename(path))
+    return written, len(rows) - written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Локальный реестр контрагентов")
+    parser.add_argument("--path", default=REGISTRY_PATH)
+    commands = parser.add_subparsers(dest="command", required=True)
+    load = commands.add_parser("load", help="загрузить выгрузку CSV")
+    load.add_argument("csv")
+    load.add_argument("--delimiter", default=",")
+    find = commands.add_parser("find", help="найти ИНН по названию")
+    find.add_argument("name")
+    find.add_argument("--limit", type=int, default=5)
+    args = parser.parse_args()
+
+    registry = Registry(args.path)
+    if args.command == "load":
+        written, skipped = load_csv(registry, args.csv, args.delimiter)
+        print(f"Записано {written}, пропущено {skipped} (неверный ИНН или пустое название), всего {len(registry)}")
+    else:
+        start = time.perf_counter()
+        (matches,) = registry.search([args.name], args.limit)
+        elapsed = time.perf_counter() - start
+        for inn, similarity in matches:
+            name, form = registry.get(inn)
+            print(f"{inn}  {similarity:5.1f}  {name} ({form or '-'})")
+        print(f"{len(matches)} совпадений за {elapsed * 1000:.1f} мс (с построением индекса)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import os
+import time
+from collections import Counter
+
+import polars as pl
+
+from async_app import process_image_async, process_image_mistral_async
+from inn_validate import inn_valid_expr
+from metrics import LatencyHistogram, inc
+
+logger = logging.getLogger(__name__)
+
+# Хеджирование: если основной провайдер не ответил за HEDGE_PERCENTILE-й
+# перцентиль своих последних задержек, тот же запрос уходит второму провайдеру
+HEDGING = os.getenv("OCR_HEDGING", "0") == "1"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", 90))
+# Задержка до хеджа, пока замеров меньше HEDGE_MIN_SAMPLES
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", 30))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", 5))
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", 200))
+# Доля ИНН с верной контрольной суммой, при которой ответ считается годным
+HEDGE_MIN_VALID_INN = float(os.getenv("HEDGE_MIN_VALID_INN", 0.5))
+
+
+def validate_page(df: pl.DataFrame | None, headers: list[str], problems: list[str]) -> bool:
+    """Ответ годен, если все строки нужной ширины, таблица не пустая
+    и достаточная доля ИНН проходит проверку контрольной суммы."""
+    if df is None or df.height == 0 or df.width != len(headers):
+        return False
+    if any("ячеек вместо" in problem for problem in problems):
+        return False
+    valid_share = df.select(inn_valid_expr(df.columns[1]).mean()).item()
+    return valid_share >= HEDGE_MIN_VALID_INN
+
+
+class HedgedRouter:
+    """Распознавание страницы с хеджированием между двумя провайдерами.
+
+    Сначала запрос уходит основному провайдеру. Если он не ответил за
+    перцентиль своих задержек или ответ не прошёл validate_page, запрос
+    дублируется другому. Побеждает первый годный ответ, проигравший отменяется.
+    """
+
+    def __init__(self, providers: dict, primary: str, percentile: float = HEDGE_PERCENTILE):
+        self.providers = providers
+        self.order = [primary] + [name for name in providers if name != primary]
+        self.percentile = percentile
+        self.latency = {name: LatencyHistogram(HEDGE_WINDOW) for name in providers}
+        self.wins = Counter()
+
+    def hedge_delay(self, name: str) -> float:
+        histogram = self.latency[name]
+        if len(histogram.samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        return histogram.percentile(self.percentile)
+
+    async def _run(
+        self,
+        name: str,
+        img,
+        headers: list[str],
+        problems: list[str],
+        stats: Counter | None = None,
+        sent: asyncio.Event | None = None,
+        **kwargs,
+    ):
+        """Задержка считается с момента отправки запроса (on_sent провайдера): ожидание
+        LLM_SEMAPHORE и кодирование фото - локальная очередь, а ответ из кэша OCR
+        запроса вовсе не делает. Ни то, ни другое не должно сдвигать перцентиль хеджа."""
+        own_stats = Counter()
+        sent_at = None
+
+        def on_sent():
+            nonlocal sent_at
+            # При повторе оборванного потока задержка считается от первой отправки
+            if sent_at is None:
+                sent_at = time.perf_counter()
+            if sent is not None:
+                sent.set()
+
+        try:
+            df = await self.providers[name](
+                img, headers, problems=problems, stats=own_stats, on_sent=on_sent, **kwargs
+            )
+        except asyncio.CancelledError:
+            # Основной провайдер отменяют, когда он медленнее хеджа: его задержка
+            # не меньше прошедшего времени, иначе хвост распределения теряется
+            if name == self.order[0] and sent_at is not None:
+                self.latency[name].add(time.perf_counter() - sent_at)
+            raise
+        finally:
+            if stats is not None:
+                stats.update(own_stats)
+        if sent_at is not None:
+            self.latency[name].add(time.perf_counter() - sent_at)
+        return df
+
+    async def __call__(
+        self,
+        img,
+        headers: list[str],
+        stats: Counter | None = None,
+        problems: list[str] | None = None,
+        on_rows=None,
+    ) -> pl.DataFrame:
+        tasks: dict[asyncio.Task, tuple[str, list[str]]] = {}
+        pending_names = list(self.order)
+        fallback = None
+        primary_sent = asyncio.Event()
+
+        def launch():
+            name = pending_names.pop(0)
+            own_problems = []
+            # Кэш OCR считаем только по основному провайдеру
+            task_stats = stats if not tasks else None
+            sent = primary_sent if not tasks else None
+            task = asyncio.create_task(
+                self._run(name, img, headers, own_problems, stats=task_stats, sent=sent, on_rows=on_rows)
+            )
+            tasks[task] = (name, own_problems)
+
+        launch()
+        hedge_at = None
+        try:
+            delay = self.hedge_delay(self.order[0])
+            while tasks:
+                waiter = None
+                timeout = None
+                if pending_names:
+                    if hedge_at is None and primary_sent.is_set():
+                        hedge_at = time.perf_counter() + delay
+                    if hedge_at is None:
+                        # Запрос ещё не отправлен (ждёт LLM_SEMAPHORE) - часы хеджа не идут
+                        waiter = asyncio.create_task(primary_sent.wait())
+                    else:
+                        timeout = max(0.0, hedge_at - time.perf_counter())
+                done, _ = await asyncio.wait(
+                    [*tasks, waiter] if waiter is not None else tasks,
+                    timeout=timeout,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                if waiter is not None:
+                    waiter.cancel()
+                    done.discard(waiter)
+                    if not done:
+                        continue
+                elif not done:
+                    # Основной провайдер медлит - дублируем запрос
+                    logger.info("hedging %s after %.1fs", self.order[0], delay)
+                    inc("ocr_hedges")
+                    launch()
+                    continue
+                for task in done:
+                    name, own_problems = tasks.pop(task)
+                    df = None if task.exception() else task.result()
+                    if validate_page(df, headers, own_problems):
+                        self.wins[name] += 1
+                        if problems is not None:
+                            problems.extend(own_problems)
+                        return df
+                    logger.warning("%s result rejected: %s", name, task.exception() or own_problems[:3])
+                    if df is not None and fallback is None:
+                        fallback = (df, own_problems)
+                if pending_names:
+                    launch()
+        finally:
+            for task in tasks:
+                task.cancel()
+
+        # Ни один ответ не прошёл проверку - отдаём первый полученный
+        if fallback is None:
+            raise RuntimeError("Ни один провайдер не распознал страницу")
+        if problems is not None:
+            problems.extend(fallback[1])
+        return fallback[0]
+
+    def summary(self) -> str:
+        lines = []
+        for name in self.providers:
+            p50 = self.latency[name].percentile(50)
+            p95 = self.latency[name].percentile(95)
+            if p50 is None:
+                lines.append(f"{name}: замеров нет")
+            else:
+                lines.append(
+                    f"{name}: p50 {p50:.1f}s, p95 {p95:.1f}s, побед {self.wins[name]}"
+                )
+        return "\n".join(lines)
+
+
+OCR_ROUTER = HedgedRouter(
+    {"mistral": process_image_mistral_async, "gpt-4o": process_image_async},
+    primary=os.getenv("OCR_PRIMARY", "mistral"),
+)
+
+
+def default_extractor():
+    return OCR_ROUTER if HEDGING else process_image_mistral_async
@@ -0,0 +1,12 @@
+"""Точка входа бота: python run_bot.py
+
+Процессы пула cpu.py (spawn) при старте выполняют модуль, запущенный как __main__.
+Здесь он пустой: бот импортируется только под защитой __name__, и процессы пула
+не тратят секунды на импорт aiogram и не создают ещё один Bot и очередь заданий.
+"""
+if __name__ == "__main__":
+    import asyncio
+
+    import app
+
+    asyncio.run(app.main())
@@ -0,0 +1,75 @@
+"""Отчёт о времени холодного старта бота.
+
+Импортирует модуль (по умолчанию app) в отдельном процессе с -X importtime
+и сводит время по пакетам верхнего уровня: кто и сколько добавляет к запуску.
+С --prewarm дополнительно замеряет providers.prewarm() - то, что бот делает
+в фоне уже после начала опроса Telegram.
+
+    python startup.py
+    python startup.py --module merge --top 15
+"""
+import argparse
+import os
+import re
+import subprocess
+import sys
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+_LINE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| ( *)(\S+)")
+
+
+def import_times(module: str) -> tuple[Counter, int]:
+    """Собственное время импорта по пакетам верхнего уровня и общее время, мкс."""
+    # Токен-заглушка: без него Bot() в app откажется создаваться. Ключи API при импорте не нужны
+    env = {"TOKEN": "1:startup", **os.environ}
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        env=env,
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    by_package = Counter()
+    total = 0
+    for line in result.stderr.splitlines():
+        match = _LINE.match(line)
+        if not match:
+            continue
+        own, cumulative, indent, name = match.groups()
+        by_package[name.split(".")[0]] += int(own)
+        if not indent:
+            total += int(cumulative)
+    return by_package, total
+
+
+def prewarm_time() -> float:
+    code = (
+        "import time, providers; start = time.perf_counter(); providers.prewarm(); "
+        "print(time.perf_counter() - start)"
+    )
+    env = {"DADATA_KEY": "startup", "OPENAI_API_KEY": "startup", **os.environ}
+    result = subprocess.run(
+        [sys.executable, "-c", code], env=env, cwd=ROOT, capture_output=True, text=True, check=True
+    )
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Время импорта модулей бота")
+    parser.add_argument("--module", default="app")
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--prewarm", action="store_true", help="замерить и фоновый прогрев провайдеров")
+    args = parser.parse_args()
+
+    by_package, total = import_times(args.module)
+    print(f"import {args.module}: {total / 1e6:.2f}s")
+    for package, own in by_package.most_common(args.top):
+        print(f"  {package:<24} {own / 1e6:6.3f}s  {own / total:5.1%}")
+    if args.prewarm:
+        print(f"providers.prewarm(): {prewarm_time():.2f}s (в фоне после старта опроса)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import polars as pl
+
+NUMBER_COLUMN = "№ п/п"
+
+
+def stitch_bands(frames: list[pl.DataFrame]) -> pl.DataFrame:
+    """Склеивает строки, распознанные по перекрывающимся полосам одной страницы.
+
+    Строка из зоны перекрытия есть в двух полосах, и у края разреза одна из копий
+    обрезана. Поэтому остаётся копия, дальше всех отстоящая (в строках) от края
+    разреза своей полосы, при равенстве - с большим числом заполненных ячеек.
+    Повторы ищутся по номеру "№ п/п", а для строк без номера - по полному
+    совпадению значений. Порядок строк - сверху вниз.
+    """
+    last = len(frames) - 1
+    marked = []
+    for band, df in enumerate(frames):
+        if df is None:
+            continue
+        position = pl.int_range(pl.len())
+        # Верх первой полосы и низ последней - края страницы, а не разрезы
+        to_top = position if band > 0 else pl.lit(None)
+        to_bottom = pl.len() - 1 - position if band < last else pl.lit(None)
+        marked.append(
+            df.with_columns(
+                __band=pl.lit(band),
+                __position=position,
+                __edge=pl.min_horizontal(to_top, to_bottom).fill_null(pl.len()),
+            )
+        )
+    df = pl.concat(marked, how="vertical_relaxed")
+    columns = [c for c in df.columns if not c.startswith("__")]
+    whole_row = pl.concat_str([pl.col(c).cast(pl.String).fill_null("") for c in columns], separator="\x1f")
+    if NUMBER_COLUMN in columns:
+        key = pl.when(pl.col(NUMBER_COLUMN).is_not_null()).then(
+            pl.lit("№") + pl.col(NUMBER_COLUMN).cast(pl.String)
+        ).otherwise(whole_row)
+    else:
+        key = whole_row
+    filled = pl.sum_horizontal(pl.col(c).is_not_null() for c in columns)
+    return (
+        df.with_columns(__key=key, __filled=filled)
+        .sort(["__edge", "__filled", "__band", "__position"], descending=[True, True, False, False])
+        .unique("__key", keep="first")
+        .sort(["__band", "__position"])
+        .select(columns)
+    )
+
+
+def _normalized(column: str) -> pl.Expr:
+    return (
+        pl.col(column)
+        .cast(pl.String)
+        .str.to_lowercase()
+        .str.replace_all(r"\s+", "")
+        .fill_null("")
+    )
+
+
+def stitch_pages(frames: list[pl.DataFrame]) -> tuple[pl.DataFrame, int, list[tuple[int, int]]]:
+    """Склеивает страницы альбома в одну таблицу без повторов.
+
+    Соседние фото часто захватывают одни и те же строки. Удаляются точные
+    повторы (совпадают все значения после нормализации регистра и пробелов)
+    и почти-повторы: тот же "№ п/п" и тот же ИНН или то же название.
+    Возвращает таблицу, число удалённых строк и пропущенные диапазоны номеров.
+    """
+    df = pl.concat([f for f in frames if f is not None], how="vertical_relaxed")
+    row_key = pl.concat_str([_normalized(c) for c in df.columns], separator="\x1f")
+    keep = row_key.is_first_distinct()
+    if NUMBER_COLUMN in df.columns:
+        number = pl.col(NUMBER_COLUMN)
+        inn_col, name_col = df.columns[1], df.columns[2]
+        first_by_inn = pl.struct(number, _normalized(inn_col).alias("inn")).is_first_distinct()
+        first_by_name = pl.struct(number, _normalized(name_col).alias("name")).is_first_distinct()
+        keep = keep & (number.is_null() | (first_by_inn & first_by_name))
+    stitched = df.filter(keep)
+    return stitched, df.height - stitched.height, missing_numbers(stitched)
+
+
+def missing_numbers(df: pl.DataFrame) -> list[tuple[int, int]]:
+    """Диапазоны номеров "№ п/п", которых нет между минимальным и максимальным."""
+    if NUMBER_COLUMN not in df.columns:
+        return []
+    numbers = (
+        df.select(pl.col(NUMBER_COLUMN).cast(pl.Int64, strict=False).drop_nulls().unique().sort())
+        .with_columns(prev=pl.col(NUMBER_COLUMN).shift(1))
+        .filter(pl.col(NUMBER_COLUMN) - pl.col("prev") > 1)
+    )
+    return [(prev + 1, current - 1) for current, prev in numbers.rows()]
+
+
+def stitch_summary(dropped: int, missing: list[tuple[int, int]]) -> str:
+    ranges = ", ".join(str(a) if a == b else f"{a}–{b}" for a, b in missing)
+    return (
+        f"Повторов между страницами удалено: {dropped}\n"
+        f"Пропущены номера: {ranges or 'нет'}"
+    )